@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+    dispatch
+    ~~~~~~~~
+
+    Measure the per-message cost of dispatching a parsed command to it's
+    ``irc_*`` handler, comparing the ``getattr("irc_%s" % command)`` lookup
+    followed by a ``gevent.sleep(0)`` which was used before, with the per class
+    dispatch table used by :meth:`~girclib.irc.IRCProtocol.handle_command`.
+
+    Usage::
+
+        python benchmarks/dispatch.py [messages]
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import sys
+import time
+import gevent
+from girclib.irc import IRCProtocol
+
+COMMANDS = ['PRIVMSG', 'PRIVMSG', 'PRIVMSG', 'JOIN', 'PART', 'QUIT', 'MODE',
+            'NOTICE', 'RPL_NAMREPLY', 'PING', 'SOMETHING_UNHANDLED']
+
+
+class NoopProtocol(IRCProtocol):
+    """
+    Protocol whose handlers do nothing so only the dispatch cost is measured.
+    """
+    def irc_PRIVMSG(self, prefix, params): pass
+    def irc_JOIN(self, prefix, params): pass
+    def irc_PART(self, prefix, params): pass
+    def irc_QUIT(self, prefix, params): pass
+    def irc_MODE(self, prefix, params): pass
+    def irc_NOTICE(self, prefix, params): pass
+    def irc_RPL_NAMREPLY(self, prefix, params): pass
+    def irc_PING(self, prefix, params): pass
+    def irc_unknown(self, prefix, command, params): pass
+
+
+def getattr_dispatch(protocol, prefix, command, params):
+    method = getattr(protocol, "irc_%s" % command, None)
+    if method is not None:
+        method(prefix, params)
+    else:
+        protocol.irc_unknown(prefix, command, params)
+    gevent.sleep(0)
+
+
+def table_dispatch(protocol, prefix, command, params):
+    protocol.handle_command(prefix, command, params)
+
+
+def run(dispatcher, protocol, messages):
+    commands = (COMMANDS * (messages / len(COMMANDS) + 1))[:messages]
+    params = ['#channel', 'Hello World']
+    start = time.time()
+    for command in commands:
+        dispatcher(protocol, 'nick!user@host', command, params)
+    return time.time() - start
+
+
+def main(messages=200000):
+    protocol = NoopProtocol()
+    for name, dispatcher in (('getattr', getattr_dispatch),
+                             ('table', table_dispatch)):
+        elapsed = run(dispatcher, protocol, messages)
+        print '%-8s %d messages in %.3fs: %.2f usec/message' % (
+            name, messages, elapsed, elapsed / messages * 1e6
+        )
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
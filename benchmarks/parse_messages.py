@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+    parse_messages
+    ~~~~~~~~~~~~~~
+
+    Measure how fast a corpus of typical IRC lines is parsed by the split and
+    join based parser gIRClib used before and by
+    :func:`~girclib.helpers.parse_irc_message`, both when only the command is
+    read, which is all that's needed to drop lines nobody listens to, and when
+    every field is decoded.
+
+    Usage::
+
+        python benchmarks/parse_messages.py [lines]
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import sys
+import time
+from girclib.constants import numeric_to_symbolic
+from girclib.helpers import ascii, parse_irc_message
+
+CORPUS = [
+    ':nick!user@host.example.org PRIVMSG #channel :Hello there, how are you?',
+    ':nick!user@host.example.org PRIVMSG #channel :\x01ACTION waves\x01',
+    ':other!~other@1.2.3.4 JOIN #channel',
+    ':other!~other@1.2.3.4 PART #channel :Leaving',
+    ':other!~other@1.2.3.4 QUIT :Ping timeout: 240 seconds',
+    ':ChanServ!ChanServ@services. MODE #channel +o nick',
+    ':irc.example.org 353 girclib = #channel :@nick +other foo bar baz',
+    ':irc.example.org 366 girclib #channel :End of /NAMES list.',
+    ':irc.example.org 372 girclib :- Message of the day line',
+    ':nick!user@host.example.org NOTICE girclib :Private notice',
+    'PING :irc.example.org',
+]
+
+
+def legacy_parse(element):
+    parts = element.strip().split(ascii(" "))
+    if parts[0].startswith(ascii(":")):
+        prefix = parts[0][1:]
+        command = parts[1]
+        args = parts[2:]
+    else:
+        prefix = None
+        command = parts[0]
+        args = parts[1:]
+
+    if command.isdigit():
+        try:
+            command = numeric_to_symbolic[command]
+        except KeyError:
+            pass
+    command = command.upper()
+
+    if args and args[0].startswith(ascii(":")):
+        args = [ascii(" ").join(args)[1:]]
+    else:
+        for idx, arg in enumerate(args):
+            if arg.startswith(ascii(":")):
+                args = args[:idx] + [ascii(" ").join(args[idx:])[1:]]
+                break
+
+    return (prefix, command, args)
+
+
+def decode_all(line):
+    return parse_irc_message(line).as_tuple()
+
+
+def run(parser, lines):
+    start = time.time()
+    for line in lines:
+        parser(line)
+    return time.time() - start
+
+
+def main(count=200000):
+    lines = (CORPUS * (count / len(CORPUS) + 1))[:count]
+    results = []
+    for name, parser in (('legacy', legacy_parse),
+                         ('command', parse_irc_message),
+                         ('decoded', decode_all)):
+        elapsed = run(parser, lines)
+        results.append(elapsed)
+        print '%-12s %d lines in %.3fs: %.0f lines/s' % (
+            name, count, elapsed, count / elapsed
+        )
+    print 'speedup: %.1fx command only, %.1fx decoded' % (
+        results[0] / results[1], results[0] / results[2]
+    )
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
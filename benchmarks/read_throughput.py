@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+    read_throughput
+    ~~~~~~~~~~~~~~~
+
+    Measure how many lines per second :class:`~girclib.irc.IRCTransport`
+    takes in from a local fake server which floods it with a ``NAMES`` like
+    burst.
+
+    Usage::
+
+        python benchmarks/read_throughput.py [lines] [drain|poll]
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import sys
+import time
+import gevent
+from gevent.event import Event
+from gevent.server import StreamServer
+from girclib.irc import IRCTransport, READ_MODE_DRAIN
+
+LINE = (':irc.example.org 353 girclib = #bench :' +
+        ' '.join(['@nick%d' % n for n in range(40)]) + '\r\n')
+
+
+class CountingTransport(IRCTransport):
+    encoding = 'utf8'
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.received = 0
+        self.done = Event()
+
+    def on_data_available(self, data):
+        self.received += 1
+        if self.received >= self.expected:
+            self.done.set()
+
+
+def main(lines=20000, read_mode=READ_MODE_DRAIN):
+    def flood(sock, address):
+        payload = LINE * 100
+        for _ in xrange(lines / 100):
+            sock.sendall(payload)
+        gevent.sleep(60)
+
+    server = StreamServer(('127.0.0.1', 0), flood)
+    server.start()
+
+    transport = CountingTransport(lines)
+    transport.read_mode = read_mode
+    start = time.time()
+    transport.connect('127.0.0.1', server.server_port)
+    transport.done.wait(60)
+    elapsed = time.time() - start
+    server.stop()
+
+    print '%-6s %d/%d lines in %.3fs: %.0f lines/s (%.1f KB/s)' % (
+        read_mode, transport.received, lines, elapsed,
+        transport.received / elapsed,
+        transport.received * len(LINE) / elapsed / 1024
+    )
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(int(args and args.pop(0) or 20000),
+         args and args.pop(0) or READ_MODE_DRAIN)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+    roster_memory
+    ~~~~~~~~~~~~~
+
+    Measure how many bytes each channel membership takes on
+    :class:`~girclib.state.StateTracker`, which keeps integer user ids on
+    channels and each user's strings once on a user table, compared with
+    keeping a ``nick -> modes`` dictionary per channel plus a
+    ``nick -> channels`` index.
+
+    The rosters are filled through the tracker's ``NAMES`` receiver, with
+    ``members`` users per channel picked from a pool of ``users`` nicks,
+    one in ten of them with a membership mode.
+
+    Usage::
+
+        python benchmarks/roster_memory.py [channels] [members] [users]
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import sys
+import random
+from girclib.irc import ServerSupportedFeatures
+from girclib.state import StateTracker
+
+
+class FakeClient(object):
+    nickname = 'girclib'
+
+    def __init__(self):
+        self.supported = ServerSupportedFeatures()
+
+
+def deep_size(roots):
+    """
+    The bytes taken by ``roots`` and everything they reference, each object
+    counted once.
+    """
+    seen = set()
+    size = 0
+    stack = list(roots)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, '__slots__'):
+            for name in obj.__slots__:
+                if hasattr(obj, name):
+                    stack.append(getattr(obj, name))
+    return size
+
+
+def make_rosters(channels, members, users):
+    random.seed(1)
+    nicks = ['user%d' % n for n in xrange(users)]
+    rosters = []
+    for idx in xrange(channels):
+        roster = []
+        for nick in random.sample(nicks, members):
+            if random.random() < 0.1:
+                nick = random.choice('@+') + nick
+            roster.append(nick)
+        rosters.append(('#channel%d' % idx, roster))
+    return rosters
+
+
+def naive_rosters(rosters, fold):
+    channels = {}
+    users = {}
+    symbols = {'@': 'o', '+': 'v'}
+    for channel, roster in rosters:
+        members = channels[fold(channel)] = {}
+        for nick in roster:
+            modes = ''
+            if nick[0] in symbols:
+                modes, nick = symbols[nick[0]], nick[1:]
+            # A copy, as it would be if read from the socket
+            nick = ''.join(list(nick))
+            members[fold(nick)] = modes
+            users.setdefault(fold(nick), set()).add(fold(channel))
+    return channels, users
+
+
+def main(channels=1000, members=200, users=50000):
+    rosters = make_rosters(channels, members, users)
+    memberships = channels * members
+
+    client = FakeClient()
+    tracker = StateTracker(client)
+    symbols = client.supported.prefix_symbols
+    for channel, roster in rosters:
+        tracker._on_joined(client, channel=channel)
+        # Parsed as ``on_names`` emits them, each nick a copy, as it would be
+        # if read from the socket
+        parsed = []
+        for nick in roster:
+            modes = ''
+            if nick[0] in symbols:
+                modes, nick = symbols[nick[0]], nick[1:]
+            parsed.append((''.join(list(nick)), modes))
+        tracker._on_names(client, channel=channel, members=parsed)
+    tracker_size = deep_size([tracker.channels, tracker.uids, tracker.table])
+
+    naive_size = deep_size(naive_rosters(rosters, client.supported.fold))
+
+    print '%d channels, %d members each, %d users' % (
+        channels, members, len(tracker.uids)
+    )
+    for name, size in (('per-nick dicts', naive_size),
+                       ('state tracker', tracker_size)):
+        print '%-15s %6.1f MB: %5.1f bytes/membership' % (
+            name, size / 1048576.0, float(size) / memberships
+        )
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:4]])
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+    split_messages
+    ~~~~~~~~~~~~~~
+
+    Measure how fast large pastes, plain ASCII and UTF-8 text, are split into
+    message lines by the ``textwrap`` based splitter gIRClib used before and
+    by :func:`~girclib.helpers.split`, and how many of the lines each one
+    makes would be too long once encoded, or would end inside a multibyte
+    character.
+
+    Usage::
+
+        python benchmarks/split_messages.py [paste_kbytes] [line_bytes]
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import sys
+import time
+import textwrap
+from girclib.helpers import split
+
+PASTES = [
+    ('ascii', u'The quick brown fox jumps over the lazy dog, again and '
+              u'again, while the paste goes on and on. '),
+    ('utf-8', u'Ol\xe1, a r\xe1pida raposa castanha salta sobre o c\xe3o '
+              u'pregui\xe7oso — 日本語のテキ'
+              u'ストも ☃ ❤ '),
+]
+
+
+def legacy_split(text, length):
+    return [chunk for line in text.split(u'\n') for
+            chunk in textwrap.wrap(line, length)]
+
+
+def check(lines, length):
+    too_long = broken = 0
+    for line in lines:
+        if isinstance(line, unicode):
+            line = line.encode('utf8')
+        if len(line) > length:
+            too_long += 1
+        try:
+            line.decode('utf8')
+        except UnicodeDecodeError:
+            broken += 1
+    return too_long, broken
+
+
+def main(kbytes=1024, length=400):
+    for name, sample in PASTES:
+        # Paragraphs a few message lines long
+        paragraph = sample * 20 + u'\n'
+        encoded = len(paragraph.encode('utf8'))
+        text = paragraph * (kbytes * 1024 / encoded + 1)
+        size = len(text.encode('utf8'))
+        for splitter_name, splitter in (('legacy', legacy_split),
+                                        ('split', split)):
+            start = time.time()
+            lines = splitter(text, length)
+            elapsed = time.time() - start
+            too_long, broken = check(lines, length)
+            print '%-6s %-7s %d bytes in %.3fs: %.1f MB/s, %d lines, ' \
+                  '%d too long, %d broken' % (
+                      name, splitter_name, size, elapsed,
+                      size / elapsed / 1024 / 1024, len(lines), too_long,
+                      broken
+                  )
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
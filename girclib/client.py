@@ -9,8 +9,11 @@
 """
 
 import girclib
+import random
+import gevent
 import logging
 from girclib import signals
+from girclib.gblinker import inline
 from girclib.irc import BaseIRCClient
 
 log = logging.getLogger(__name__)
@@ -51,8 +54,13 @@ class IRCClient(BasicIRCClient):
     defines some methods that you can just override to get your own client
     doing what you want.
 
+    These methods are marked with :func:`~girclib.gblinker.inline` since they
+    do nothing or close to nothing, overriding them drops the mark, ie, your
+    own methods are run on their own greenlet unless you mark them too.
+
     """
 
+    @inline
     def on_ctcp_query_finger(self, emitter, user=None, channel=None, data=None):
         """
         In case you implement a finger reply, a response should be made like::
@@ -64,62 +72,74 @@ class IRCClient(BasicIRCClient):
 
         """
 
+    @inline
     def on_rpl_topic(self, emitter, user=None, channel=None, new_topic=None):
         """
         See :meth:`~girclib.signals.on_rpl_topic`.
         """
 
+    @inline
     def on_rpl_notopic(self, emitter, user=None, channel=None):
         """
         See :meth:`~girclib.signals.on_rpl_notopic`.
         """
 
+    @inline
     def on_rpl_created(self, emitter, when=None):
         """
         See :meth:`~girclib.signals.on_rpl_created`.
         """
 
+    @inline
     def on_rpl_yourhost(self, emitter, info=None):
         """
         See :meth:`~girclib.signals.on_rpl_yourhost`.
         """
 
+    @inline
     def on_rpl_myinfo(self, emitter, servername=None, version=None,
                       umodes=None, cmodes=None):
         """
         See :meth:`~girclib.signals.on_rpl_myinfo`.
         """
 
+    @inline
     def on_rpl_bounce(self, emitter, info=None):
         """
         See :meth:`~girclib.signals.on_rpl_bounce`.
         """
 
+    @inline
     def on_rpl_isupport(self, emitter, options=None):
         """
         See :meth:`~girclib.signals.on_rpl_isupport`.
         """
 
+    @inline
     def on_rpl_luserclient(self, emitter, info=None):
         """
         See :meth:`~girclib.signals.on_rpl_luserclient`.
         """
 
+    @inline
     def on_rpl_luserop(self, emitter, ops=None):
         """
         See :meth:`~girclib.signals.on_rpl_luserop`.
         """
 
+    @inline
     def on_rpl_luserchannels(self, emitter, channels=None):
         """
         See :meth:`~girclib.signals.on_rpl_luserchannels`.
         """
 
+    @inline
     def on_rpl_luserme(self, emitter, info=None):
         """
         See :meth:`~girclib.signals.on_rpl_luserme`.
         """
 
+    @inline
     def on_signed_on(self, emitter):
         """
         Here you can join channels for example
@@ -127,112 +147,291 @@ class IRCClient(BasicIRCClient):
         See :meth:`~girclib.signals.on_signed_on`.
         """
 
+    @inline
     def on_motd(self, emitter, motd=None):
         """
         See :meth:`~girclib.signals.on_motd`.
         """
 
+    @inline
     def on_nickname_in_use(self, emitter, nickname=None):
         """
         See :meth:`~girclib.signals.on_nickname_in_use`.
         """
         emitter.set_nick("_%s" % nickname)
 
+    @inline
     def on_erroneous_nickname(self, emitter, nickname=None):
         """
         See :meth:`~girclib.signals.on_erroneous_nickname`.
         """
         emitter.set_nick(self.erroneous_nick_fallback)
 
+    @inline
     def on_password_mismatch(self, emitter):
         """
         See :meth:`~girclib.signals.on_password_mismatch`.
         """
 
+    @inline
     def on_joined(self, emitter, channel=None):
         """
         See :meth:`~girclib.signals.on_joined`.
         """
 
+    @inline
     def on_user_joined(self, emitter, channel=None, user=None):
         """
         See :meth:`~girclib.signals.on_user_joined`.
         """
 
+    @inline
     def on_left(self, emitter, channel=None):
         """
         See :meth:`~girclib.signals.on_left`.
         """
 
+    @inline
     def on_user_left(self, emitter, channel=None, user=None):
         """
         See :meth:`~girclib.signals.on_user_left`.
         """
 
+    @inline
     def on_user_quit(self, emitter, user=None, message=None):
         """
         See :meth:`~girclib.signals.on_user_quit`.
         """
 
+    @inline
     def on_mode_changed(self, emitter, user=None, channel=None, set=None,
                         modes=None, args=None):
         """
         See :meth:`~girclib.signals.on_mode_changed`.
         """
 
+    @inline
     def on_chanmsg(self, emitter, channel=None, user=None, message=None):
         """
         See :meth:`~girclib.signals.on_chanmsg`.
         """
 
+    @inline
     def on_privmsg(self, emitter, user=None, message=None):
         """
         See :meth:`~girclib.signals.on_privmsg`.
         """
 
+    @inline
     def on_notice(self, emitter, user=None, channel=None, message=None):
         """
         See :meth:`~girclib.signals.on_notice`.
         """
 
+    @inline
     def on_nick_changed(self, emitter, user=None, newnick=None):
         """
         See :meth:`~girclib.signals.on_nick_changed`.
         """
 
+    @inline
     def on_user_renamed(self, emitter, user=None, newnick=None):
         """
         See :meth:`~girclib.signals.on_user_renamed`.
         """
 
+    @inline
     def on_kicked(self, emitter, channel=None, kicker=None, message=None):
         """
         See :meth:`~girclib.signals.on_kicked`.
         """
 
 
+    @inline
     def on_user_kicked(self, emitter, channel=None, kicked=None, kicker=None,
                        message=None):
         """
         See :meth:`~girclib.signals.on_user_kicked`.
         """
 
+    @inline
     def on_banned(self, emitter, channel=None, message=None):
         """
         See :meth:`~girclib.signals.on_banned`.
         """
 
+    @inline
     def on_user_banned(self, emitter, channel=None, user=None, message=None):
         """
         See :meth:`~girclib.signals.on_user_banned`.
         """
 
+    @inline
     def on_topic_changed(self, emitter, user=None, channel=None, new_topic=None):
         """
         See :meth:`~girclib.signals.on_topic_changed`.
         """
 
 
+class ConnectionSupervisor(object):
+    """
+    Keeps a :class:`~girclib.client.BasicIRCClient` connected.
+
+    When the connection fails or is lost, a reconnection is scheduled after a
+    delay which doubles, with some random jitter, on each consecutive
+    failure, up to ``max_delay`` seconds. Failing to get signed on to a
+    server moves on to the next one on ``servers``.
+
+    Once signed on again, the nickname in use and the channels joined before
+    the connection was lost are restored, the channels being joined, once
+    the server told us what it supports, or at the end of it's message of
+    the day, with :meth:`~girclib.irc.IRCCommandsHelper.join_many`, in as
+    few ``JOIN`` lines as the server allows, sent in one go without waiting
+    for each one's reply. The outcome is kept as ``rejoined``, and channels which
+    couldn't be joined again are logged.
+
+    Quitting the client, see :meth:`~girclib.irc.IRCCommandsHelper.quit`,
+    stops the supervisor.
+
+    :type servers: ``list`` of ``(host, port)``
+    :param servers: The servers to connect to, defaults to the client's
+                    ``host`` and ``port``.
+
+    :type keys: ``dict``
+    :param keys: Channel keys to use when re-joining channels.
+    """
+
+    def __init__(self, client, servers=None, min_delay=1, max_delay=300,
+                 jitter=0.5, timeout=30, keys=None):
+        self.client = client
+        self.servers = list(servers or [(client.host, client.port)])
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.timeout = timeout
+        self.keys = keys or {}
+        self.channels = []
+        self.nickname = None
+        self.failures = 0
+        self._server_idx = 0
+        self._signed_on = False
+        self._stopped = True
+        self._retry = None
+        self._rejoin = None
+        self.rejoined = None
+
+        for signame in ('on_disconnected', 'on_quited', 'on_signed_on',
+                        'on_rpl_isupport', 'on_motd', 'on_nick_changed',
+                        'on_joined', 'on_left', 'on_kicked'):
+            getattr(signals, signame).connect(
+                getattr(self, '_%s' % signame), sender=client, weak=False
+            )
+
+    def start(self):
+        """
+        Connect the client and keep it connected.
+        """
+        self._stopped = False
+        self._connect()
+
+    def stop(self):
+        """
+        Stop reconnecting the client. It is not disconnected.
+        """
+        self._stopped = True
+        if self._retry is not None:
+            self._retry.kill(block=False)
+            self._retry = None
+
+    def get_delay(self):
+        """
+        The seconds to wait before the next connection attempt.
+        """
+        delay = min(self.max_delay, self.min_delay * 2 ** self.failures)
+        return delay * (1 - self.jitter * random.random())
+
+    def _connect(self):
+        self._retry = None
+        if self._stopped:
+            return
+        host, port = self.servers[self._server_idx % len(self.servers)]
+        self.client.host, self.client.port = host, port
+        if self.nickname:
+            self.client.nickname = self.nickname
+        self._signed_on = False
+        self._rejoin = None
+        log.info("Connecting to %s:%s", host, port)
+        self.client.connect(timeout=self.timeout)
+
+    @inline
+    def _on_disconnected(self, emitter):
+        if self._stopped or self._retry is not None:
+            return
+        if not self._signed_on:
+            # Didn't make it with this server, try the next one
+            self._server_idx += 1
+        delay = self.get_delay()
+        self.failures += 1
+        log.info("Reconnecting in %.1f seconds", delay)
+        self._retry = gevent.spawn_later(delay, self._connect)
+
+    @inline
+    def _on_quited(self, emitter):
+        self.stop()
+
+    @inline
+    def _on_signed_on(self, emitter):
+        self._signed_on = True
+        self.failures = 0
+        self.nickname = self.client.nickname
+        # The server's TARGMAX and CHANLIMIT, which join_many() packs the
+        # channels by, only follow the welcome
+        self._rejoin, self.channels = self.channels, []
+
+    @inline
+    def _on_rpl_isupport(self, emitter, options=None):
+        self._rejoin_channels()
+
+    @inline
+    def _on_motd(self, emitter, motd=None):
+        # For servers which send no ISUPPORT
+        self._rejoin_channels()
+
+    def _rejoin_channels(self):
+        channels, self._rejoin = self._rejoin, None
+        if channels:
+            self.rejoined = self.client.join_many(channels, self.keys)
+            gevent.spawn(self._report_rejoined, self.rejoined)
+
+    def _report_rejoined(self, result):
+        result.wait(self.timeout)
+        for channel, (error, message) in result.failed.iteritems():
+            log.warning("Failed to join %s again: %s", channel, message)
+
+    @inline
+    def _on_nick_changed(self, emitter, user=None, newnick=None):
+        self.nickname = newnick
+
+    @inline
+    def _on_joined(self, emitter, channel=None):
+        equals = emitter.supported.fold.equals
+        for joined in self.channels:
+            if equals(joined, channel):
+                return
+        self.channels.append(channel)
+
+    @inline
+    def _on_left(self, emitter, channel=None):
+        equals = emitter.supported.fold.equals
+        self.channels = [
+            joined for joined in self.channels if not equals(joined, channel)
+        ]
+
+    @inline
+    def _on_kicked(self, emitter, channel=None, kicker=None, message=None):
+        self._on_left(emitter, channel=channel)
+
+
 if __name__ == '__main__':
     import sys
     import gevent
@@ -256,23 +455,19 @@ if __name__ == '__main__':
     server = BackdoorServer(('127.0.0.1', 2000), locals=locals())
     server.start()
 
-    nicks = []
-
-    @signals.on_rpl_namreply.connect
-    def on_rpl_namreply(emitter, users=None, channel=None, privacy=None):
-        if users:
-            nicks.extend(users)
-
-
-    @signals.on_rpl_endofnames.connect
-    def on_rpl_endofnames(emitter, channel=None):
+    def ping_members(members):
         gevent.sleep(2)
-        for nick in nicks:
+        for nick, modes in members:
             if nick == "girclib":
                 continue
             client.ping(nick)
             gevent.sleep(20)    # Some networks require us to wait before another ping
 
+    @signals.on_names.connect
+    def on_names(emitter, channel=None, members=None, privacy=None):
+        # Don't hold up the connection while pinging
+        gevent.spawn(ping_members, members)
+
 
     @signals.on_signed_on.connect
     def _on_motd(emitter):
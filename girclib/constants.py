@@ -318,6 +318,14 @@ symbolic_to_numeric["NONRFC_RPL_333"] = '333'
 NONRFC_RPL_439 = 439
 symbolic_to_numeric["NONRFC_RPL_439"] = '439'
 
+# The WHOX extension's WHO reply, carrying only the fields asked for on the
+# WHO query, in a fixed order, and the query's token.
+# Example:
+#    WHO #boredom %tcuhnfar,152
+#    354 IAmBored 152 #boredom ~user host.example.org nick H@ account :Real Name
+RPL_WHOSPCRPL = '354'
+symbolic_to_numeric["RPL_WHOSPCRPL"] = '354'
+
 numeric_to_symbolic = {}
 for k, v in symbolic_to_numeric.items():
     numeric_to_symbolic[v] = k
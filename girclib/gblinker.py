@@ -8,22 +8,82 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import types
 import logging
 import blinker.base
-from gevent.pool import Pool
+from blinker.base import ANY, ANY_ID, WeakTypes, hashable_identity
+from gevent.pool import Group, Pool
 
 log = logging.getLogger(__name__)
 
+def _sender_identity(sender):
+    # hashable_identity() looks for method attributes on every sender, which
+    # is slow for clients, the usual senders, so only call it when needed
+    if isinstance(sender, (types.MethodType, basestring)):
+        return hashable_identity(sender)
+    return id(sender)
+
+def inline(receiver):
+    """
+    Decorator marking *receiver* as cheap enough to be run inline, on the
+    emitting greenlet, instead of on a greenlet of it's own.
+
+    Use it for receivers which don't block, like counters, loggers or state
+    trackers::
+
+        @signals.on_chanmsg.connect
+        @inline
+        def count_messages(emitter, channel=None, user=None, message=None):
+            counts[channel] += 1
+
+    """
+    receiver._girclib_inline = True
+    return receiver
+
+def observer(receiver):
+    """
+    Decorator marking *receiver* as only observing the signal, like a state
+    tracker does, so that it being connected doesn't change how the emitter
+    behaves, ie, it doesn't make a client deliver batches as a whole, see
+    :data:`~girclib.signals.on_batch`.
+    """
+    receiver._girclib_observer = True
+    return receiver
+
+
 class NamedSignal(blinker.base.NamedSignal):
-    def __init__(self, name, doc=None):
+    """
+    A named signal whose receivers, by default, are each run on their own
+    greenlet.
+
+    Receivers marked with :func:`inline`, or all of them if the signal was
+    created with ``inline=True``, are run on the emitting greenlet instead,
+    saving the greenlet and pool overhead.
+
+    The greenlets spawned by an emission belong to that emission only, so a
+    slow receiver only delays the emission it was spawned for. How long an
+    emission waits for it's receivers can be limited with ``timeout``
+    (receivers still running are not killed, just no longer waited for), and
+    how many receivers an emission runs at the same time with
+    ``concurrency``.
+
+    Receivers are looked up by their sender's identity, so emitting for one
+    sender costs the same no matter how many other senders, ie, connections,
+    the signal has receivers for.
+    """
+    def __init__(self, name, doc=None, inline=False, timeout=None,
+                 concurrency=None):
         super(NamedSignal, self).__init__(name, doc=doc)
-        self.pool = Pool()
+        self.inline = inline
+        self.timeout = timeout
+        self.concurrency = concurrency
 
     def send(self, *sender, **kwargs):
         """Emit this signal on behalf of *sender*, passing on \*\*kwargs.
 
         Returns a list of 2-tuples, pairing receivers with their return
-        value. The ordering of receiver notification is undefined.
+        value. The ordering of receiver notification is undefined. Receivers
+        still running once the signal's ``timeout`` expires are left out.
 
         :param \*sender: Any object or ``None``.  If omitted, synonymous
                          with ``None``.  Only accepts one positional argument.
@@ -34,49 +94,153 @@ class NamedSignal(blinker.base.NamedSignal):
         # Using '*sender' rather than 'sender=None' allows 'sender' to be
         # used as a keyword argument- i.e. it's an invisible name in the
         # function signature.
+        return self._send(self._get_sender(sender), kwargs, [])
+
+    def emit(self, *sender, **kwargs):
+        """
+        Same as :meth:`send` but the receivers return values are not
+        collected. Returns ``None``.
+        """
+        self._send(self._get_sender(sender), kwargs, None)
+
+    def receivers_for(self, sender):
+        """Iterate all live receivers listening for *sender*."""
+        by_sender = self._by_sender
+        # Use get() so that senders without receivers aren't added to the
+        # defaultdict
+        any_ids = by_sender.get(ANY_ID)
+        if sender is ANY:
+            sender_ids = None
+        else:
+            sender_ids = by_sender.get(_sender_identity(sender))
+        if any_ids and sender_ids:
+            ids = any_ids | sender_ids
+        elif any_ids or sender_ids:
+            # Copy since the set might change while iterating
+            ids = tuple(any_ids or sender_ids)
+        else:
+            return
+
+        receivers = self.receivers
+        for receiver_id in ids:
+            receiver = receivers.get(receiver_id)
+            if receiver is None:
+                continue
+            if isinstance(receiver, WeakTypes):
+                strong = receiver()
+                if strong is None:
+                    self._disconnect(receiver_id, ANY_ID)
+                    continue
+                receiver = strong
+            yield receiver
+
+    def has_receivers_for(self, sender):
+        """
+        Whether any receiver is connected for *sender*, or for any sender.
+
+        Receivers which are about to be garbage collected still count, so
+        this might return ``True`` even if no receiver is called.
+        """
+        if not self.receivers:
+            return False
+        by_sender = self._by_sender
+        if by_sender.get(ANY_ID):
+            return True
+        elif sender is ANY:
+            return False
+        return bool(by_sender.get(_sender_identity(sender)))
+
+    def is_connected(self, receiver, sender=ANY):
+        """
+        Whether *receiver* is connected to this signal for *sender*.
+        """
+        if sender is ANY:
+            sender_id = ANY_ID
+        else:
+            sender_id = hashable_identity(sender)
+        return hashable_identity(receiver) in self._by_sender.get(sender_id, ())
+
+    def _disconnect(self, receiver_id, sender_id):
+        if sender_id != ANY_ID:
+            return super(NamedSignal, self)._disconnect(receiver_id, sender_id)
+        # Only visit the senders the receiver is connected for instead of
+        # every sender the signal knows about
+        for connected_sender_id in self._by_receiver.pop(receiver_id, ()):
+            bucket = self._by_sender.get(connected_sender_id)
+            if bucket is not None:
+                bucket.discard(receiver_id)
+        self.receivers.pop(receiver_id, None)
+
+    def _get_sender(self, sender):
         if len(sender) == 0:
-            sender = None
+            return None
         elif len(sender) > 1:
             raise TypeError('send() accepts only one positional argument, '
                             '%s given' % len(sender))
-        else:
-            sender = sender[0]
+        return sender[0]
 
-        try:
-            sender_name = '.'.join([str(sender.__module__),
-                                    sender.__class__.__name__])
-        except:
-            sender_name = sender
+    def _send(self, sender, kwargs, results):
+        if log.isEnabledFor(5):
+            try:
+                sender_name = '.'.join([str(sender.__module__),
+                                        sender.__class__.__name__])
+            except:
+                sender_name = sender
 
-        log.log(5, "signal: %r  sender: %r  kwargs: %r  receivers: %r",
-                self.name, sender_name, kwargs, self.receivers)
+            log.log(5, "signal: %r  sender: %r  kwargs: %r  receivers: %r",
+                    self.name, sender_name, kwargs, self.receivers)
 
         if not self.receivers:
-            return []
+            return results
 
-        results = []
+        def run_receiver(receiver, sender, kwargs):
+            try:
+                result = receiver(sender, **kwargs)
+            except Exception, err:
+                log.error("Failed to run receiver %r for signal %r",
+                          receiver, self.name)
+                log.exception(err)
+            else:
+                if results is not None:
+                    results.append((receiver, result))
 
         def spawned_receiver(receiver, sender, kwargs):
             log.log(5, "spawned %r for signal %r, sender: %r  kwargs: %r",
                     receiver, self.name, sender, kwargs)
-            try:
-                results.append((receiver, receiver(sender, **kwargs)))
-            except Exception, err:
-                log.error("Failed to run spawned function")
-                log.exception(err)
+            run_receiver(receiver, sender, kwargs)
 
+        group = None
         for receiver in self.receivers_for(sender):
+            if self.inline or getattr(receiver, '_girclib_inline', False):
+                run_receiver(receiver, sender, kwargs)
+                continue
+            if group is None:
+                if self.concurrency:
+                    group = Pool(self.concurrency)
+                else:
+                    group = Group()
             log.log(5, "Spawning for receiver: %s", receiver)
-            self.pool.spawn(spawned_receiver, receiver, sender, kwargs)
+            # Blocks while the pool is full
+            group.spawn(spawned_receiver, receiver, sender, kwargs)
 
-        # Wait for results
-        self.pool.join()
+        if group is not None:
+            # Wait for results
+            group.join(timeout=self.timeout)
+            if len(group):
+                log.warning("%d receiver(s) of signal %r still running after "
+                            "%ss, not waiting for them", len(group),
+                            self.name, self.timeout)
+                if results is not None:
+                    # Those receivers would keep adding to the list handed
+                    # to the caller
+                    return list(results)
         return results
 
 class Namespace(blinker.base.Namespace):
     """A mapping of signal names to signals."""
 
-    def signal(self, name, doc=None):
+    def signal(self, name, doc=None, inline=False, timeout=None,
+               concurrency=None):
         """Return the :class:`NamedSignal` *name*, creating it if required.
 
         Repeated calls to this function will return the same signal object.
@@ -85,6 +249,9 @@ class Namespace(blinker.base.Namespace):
         try:
             return self[name]
         except KeyError:
-            return self.setdefault(name, NamedSignal(name, doc))
+            return self.setdefault(name, NamedSignal(
+                name, doc, inline=inline, timeout=timeout,
+                concurrency=concurrency
+            ))
 
 signal = Namespace().signal
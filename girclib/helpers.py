@@ -10,12 +10,15 @@
 
 import re
 import sys
+import time
 import types
+import codecs
 import string
 import logging
-import textwrap
 from girclib.constants import numeric_to_symbolic
-from girclib.exceptions import IRCBadModes, UnhandledCommand
+from girclib.exceptions import IRCBadMessage, IRCBadModes, UnhandledCommand
+
+log = logging.getLogger(__name__)
 
 NUL     = chr(0)
 CR      = chr(015)
@@ -25,6 +28,9 @@ SPC     = chr(040)
 
 # This includes the CRLF terminator characters.
 MAX_COMMAND_LENGTH = 512
+# IRCv3 message tags, including the leading '@' and the trailing space, can
+# take this many bytes on top of MAX_COMMAND_LENGTH
+MAX_TAGS_LENGTH = 8191
 CHANNEL_PREFIXES = '&#!+'
 
 # Python < 3 compatibility
@@ -37,6 +43,92 @@ def ascii(data):
     """Convert an ASCII string to a native string"""
     return bytes(data, encoding='ascii')
 
+# The characters each CASEMAPPING folds, besides ASCII letters
+_CASEMAPPINGS = {
+    'ascii': ('', ''),
+    'rfc1459': ('[]\\~', '{}|^'),
+    'strict-rfc1459': ('[]\\', '{}|'),
+}
+
+class CaseFolder(object):
+    """
+    Fold nicks and channel names, according to one of the ``CASEMAPPING``
+    values servers advertise, ``ascii``, ``rfc1459`` or ``strict-rfc1459``,
+    so that names which are the same for the server compare equal.
+
+    The fold is done by ``str.translate`` with a table built once per
+    casemapping, and folded names are memoized, up to ``cache_size`` of them,
+    since the same names are folded over and over. Unknown casemappings
+    fold like ``rfc1459``, the default.
+
+    Use :meth:`get` to get the shared folder of a casemapping.
+
+    :ivar casemapping: The casemapping name.
+    :ivar table: The ``str.translate`` table.
+    """
+    cache_size = 16384
+    _folders = {}
+
+    def __init__(self, casemapping='rfc1459'):
+        if casemapping not in _CASEMAPPINGS:
+            log.warning("Unknown casemapping %r, using rfc1459", casemapping)
+            casemapping = 'rfc1459'
+        upper, lower = _CASEMAPPINGS[casemapping]
+        self.casemapping = casemapping
+        self.table = string.maketrans(string.ascii_uppercase + upper,
+                                      string.ascii_lowercase + lower)
+        self._unicode_table = dict([
+            (ord(upper), ord(lower)) for upper, lower in
+            zip(string.ascii_uppercase + upper, string.ascii_lowercase + lower)
+        ])
+        self._cache = {}
+
+    @classmethod
+    def get(cls, casemapping='rfc1459'):
+        """
+        The shared :class:`CaseFolder` for ``casemapping``.
+        """
+        try:
+            return cls._folders[casemapping]
+        except KeyError:
+            folder = cls._folders[casemapping] = cls(casemapping)
+            return folder
+
+    def __call__(self, name):
+        """
+        Fold ``name``.
+        """
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+        if name is None:
+            return None
+        elif isinstance(name, str):
+            folded = name.translate(self.table)
+        else:
+            folded = name.translate(self._unicode_table)
+        if folded == name:
+            # Most names are folded already, keep a single copy
+            folded = name
+        cache = self._cache
+        if len(cache) >= self.cache_size:
+            cache.clear()
+        cache[name] = folded
+        return folded
+
+    fold = __call__
+
+    def equals(self, name, other):
+        """
+        Whether ``name`` and ``other`` are the same, once folded.
+        """
+        return name == other or self(name) == self(other)
+
+    def __repr__(self):
+        return '<CaseFolder %s>' % self.casemapping
+
+
 def parse_modes(modes, params, param_modes=('', '')):
     """
     Parse an IRC mode string.
@@ -95,25 +187,90 @@ def parse_modes(modes, params, param_modes=('', '')):
 
     return changes
 
-def split(text, length=80):
+def split(text, length=80, encoding='utf8'):
     """
-    Split a string into multiple lines.
+    Split a string into multiple lines, of at most ``length`` bytes once
+    encoded.
+
+    The last space before ``length`` bytes will be preferred as a breaking
+    point, and dropped. Line breaks will also be used as breaking points,
+    empty lines being dropped. When the encoding is UTF-8, lines are never
+    split inside a multibyte character.
 
-    White-space near ``str[length]`` will be preferred as a breaking point.
-    "``\\n``" will also be used as a breaking point.
+    The text is encoded once and scanned once, only looking back for a
+    space from where each line would end, so it takes linear time.
 
-    :param str: The string to split.
-    :type  str: ``str``
+    :param text: The string to split, encoded with ``encoding`` unless it's
+                 ``unicode``.
+    :type  text: ``str``, ``unicode``
 
-    :param length: The maximum length which will be allowed for any string in
-                   the result.
+    :param length: The maximum length, in bytes, which will be allowed for
+                   any string in the result.
     :type  length: ``int``
 
-    :rtype: ``list`` of ``str``
+    :param encoding: The encoding to encode ``text`` with, or which it's
+                     encoded with.
+    :type  encoding: ``str``
+
+    :rtype: ``list`` of encoded ``str``
+
+    """
+    if length < 1:
+        raise ValueError("Can't split into lines of %d bytes" % length)
+    if isinstance(text, unicode):
+        text = text.encode(encoding)
+    utf8 = codecs.lookup(encoding).name == 'utf-8'
+    chunks = []
+    append = chunks.append
+    for line in text.splitlines():
+        start, end = 0, len(line)
+        while end - start > length:
+            stop = start + length
+            # A space right at ``stop`` can go too, it's dropped
+            cut = line.rfind(' ', start, stop + 1)
+            if cut > start:
+                append(line[start:cut])
+                start = cut + 1
+                continue
+            if utf8:
+                # Back off to the first byte of the character ``stop`` is in
+                while stop > start and '\x80' <= line[stop] < '\xc0':
+                    stop -= 1
+                if stop == start:
+                    # Not UTF-8 after all
+                    stop = start + length
+            append(line[start:stop])
+            start = stop
+        if start < end:
+            append(line[start:])
+    return chunks
+
+def pack_targets(targets, max_targets=None, max_length=MAX_COMMAND_LENGTH):
+    """
+    Pack ``targets`` into comma separated lists, for commands taking several
+    targets, each with at most ``max_targets`` targets, ``None`` meaning
+    any number, and at most ``max_length`` bytes long.
+
+    A target longer than ``max_length`` goes on a list of it's own.
 
+    :rtype: ``list`` of ``str``
     """
-    return [chunk for line in text.split(ascii('\n')) for
-            chunk in textwrap.wrap(line, length)]
+    packed = []
+    batch = []
+    size = 0
+    for target in targets:
+        if batch and (len(batch) == max_targets or
+                      size + 1 + len(target) > max_length):
+            packed.append(ascii(',').join(batch))
+            batch = []
+        if batch:
+            size += 1 + len(target)
+        else:
+            size = len(target)
+        batch.append(target)
+    if batch:
+        packed.append(ascii(',').join(batch))
+    return packed
 
 def _int_or_default(value, default=None):
     """
@@ -267,13 +424,170 @@ def ctcp_stringify(messages):
     return ascii("").join(coded_messages)
 
 
-def parse_raw_irc_command(element):
+# Marks message fields which were not decoded yet
+_UNPARSED = object()
+
+class IRCMessage(object):
     """
-    This function parses a raw irc command and returns a tuple
-    of (prefix, command, args).
-    The following is a pseudo BNF of the input text::
+    A message received from an IRC server.
+
+    It can be unpacked as the ``(prefix, command, params)`` tuple
+    :func:`parse_raw_irc_command` returns.
+
+    Messages returned by :func:`parse_irc_message` only have their command
+    decoded up front, the prefix and parameters are only decoded when first
+    read.
+
+    :ivar prefix: The message origin, ``None`` if the message has none.
+    :ivar command: The upper-cased command, or it's symbolic name if it's a
+                   known numeric reply, see :mod:`girclib.constants`.
+    :ivar params: ``list`` of the message parameters, the trailing one
+                  included.
+    :ivar raw: The line the message was parsed from.
+    :ivar tags: ``dict`` of the IRCv3 message tags, empty if the message has
+                none. See :func:`parse_message_tags`.
+    """
+    __slots__ = ('command', 'raw', '_match', '_prefix', '_params', '_tags')
+
+    def __init__(self, prefix, command, params, raw=None, tags=None,
+                 _match=None):
+        self.command = command
+        self.raw = raw
+        self._match = _match
+        self._prefix = prefix
+        self._params = params
+        self._tags = tags
+
+    def _get_tags(self):
+        tags = self._tags
+        if tags is None:
+            tags = self._tags = {}
+        elif not isinstance(tags, dict):
+            # Still the raw tags
+            tags = self._tags = parse_message_tags(tags)
+        return tags
+
+    def _set_tags(self, tags):
+        self._tags = tags
+
+    tags = property(_get_tags, _set_tags)
+
+    @property
+    def tagged(self):
+        """
+        Whether the message has IRCv3 message tags, without parsing them.
+        """
+        return bool(self._tags)
+
+    def _get_prefix(self):
+        if self._prefix is _UNPARSED:
+            self._prefix = self._match.group(1)
+        return self._prefix
+
+    def _set_prefix(self, prefix):
+        self._prefix = prefix
+
+    prefix = property(_get_prefix, _set_prefix)
 
-        <message>  ::= [':' <prefix> <SPACE> ] <command> <params> <crlf>
+    def _get_params(self):
+        if self._params is _UNPARSED:
+            self._params = _split_params(self._match.string,
+                                         self._match.end())
+        return self._params
+
+    def _set_params(self, params):
+        self._params = params
+
+    params = property(_get_params, _set_params)
+
+    def __iter__(self):
+        return iter(self.as_tuple())
+
+    def as_tuple(self):
+        """
+        The ``(prefix, command, params)`` tuple.
+        """
+        match = self._match
+        if match is not None:
+            if self._prefix is _UNPARSED:
+                self._prefix = match.group(1)
+            if self._params is _UNPARSED:
+                self._params = _split_params(match.string, match.end())
+        return (self._prefix, self.command, self._params)
+
+    def __repr__(self):
+        return '<IRCMessage prefix=%r command=%r params=%r>' % (
+            self.prefix, self.command, self.params
+        )
+
+
+# Tag keys which are found on most tagged messages, parsed tags share these
+# strings instead of each holding a copy
+_TAG_KEYS = dict([
+    (key, intern(key)) for key in ('time', 'msgid', 'account', 'batch')
+])
+
+_TAG_UNESCAPES = {':': ';', 's': SPC, '\\': '\\', 'r': CR, 'n': NL}
+_tag_escape_re = re.compile(r'\\(.?)', re.DOTALL)
+
+def _unescape_tag_value(match):
+    char = match.group(1)
+    return _TAG_UNESCAPES.get(char, char)
+
+def parse_message_tags(data):
+    """
+    Parse the IRCv3 message tags of a line, without the leading ``@``, ie,
+    ``time=2011-10-19T16:40:51.620Z;msgid=63E1033A051D4B41B1AB1FA3CF4B243E``.
+
+    Escaped values are unescaped. Tags without a value get an empty string.
+
+    :rtype: ``dict``
+    """
+    tags = {}
+    for tag in data.split(';'):
+        if not tag:
+            continue
+        key, sep, value = tag.partition('=')
+        if '\\' in value:
+            value = _tag_escape_re.sub(_unescape_tag_value, value)
+        tags[_TAG_KEYS.get(key, key)] = value
+    return tags
+
+
+def format_message_tags(tags):
+    """
+    Format a ``dict`` of IRCv3 message tags as the ``@tags`` which starts a
+    line, including the trailing space. Tags whose value is ``None``,
+    ``True`` or an empty string are sent without one.
+
+    Returns an empty string if there are no tags.
+    """
+    if not tags:
+        return ''
+    formatted = []
+    for key, value in sorted(tags.iteritems()):
+        if value is None or value is True or value == '':
+            formatted.append(key)
+            continue
+        value = value.replace('\\', '\\\\').replace(';', '\\:').replace(
+            SPC, '\\s').replace(CR, '\\r').replace(NL, '\\n')
+        formatted.append('%s=%s' % (key, value))
+    return '@%s ' % ';'.join(formatted)
+
+
+# Finds a line's prefix and command, the parameters start where it ends
+_message_re = re.compile(r' *(?::([^ ]+) +)?([^ :][^ ]*|) *', re.DOTALL)
+
+def parse_irc_message(line):
+    """
+    Parse a line received from an IRC server into an :class:`IRCMessage`.
+
+    The line is scanned once, by a compiled regular expression and C level
+    string methods, following the RFC 1459 and RFC 2812 message format, plus
+    IRCv3 message tags::
+
+        <message>  ::= ['@' <tags> <SPACE> ] [':' <prefix> <SPACE> ] <command>
+                       <params> <crlf>
         <prefix>   ::= <servername> | <nick> [ '!' <user> ] [ '@' <host> ]
         <command>  ::= <letter> { <letter> } | <number> <number> <number>
         <SPACE>    ::= ' ' { ' ' }
@@ -286,37 +600,105 @@ def parse_raw_irc_command(element):
 
         <crlf>     ::= CR LF
 
+    Runs of spaces separate parameters like a single space does, the
+    trailing parameter is kept verbatim, and, as RFC 2812 says, the 15th
+    parameter is always the trailing one even without it's leading ``:``.
+
+    Only the command is decoded right away, see :class:`IRCMessage`. Message
+    tags are only parsed once :attr:`IRCMessage.tags` is read.
 
+    :raises: :class:`~girclib.exceptions.IRCBadMessage` if the line holds no
+             command.
     """
-    parts = element.strip().split(ascii(" "))
-    if parts[0].startswith(ascii(":")):
-        prefix = parts[0][1:]
-        command = parts[1]
-        args = parts[2:]
+    raw = line
+    if line[-1:] in (CR, NL):
+        line = line.rstrip(CR + NL)
+    tags = None
+    if line[:1] == '@':
+        sp = line.find(SPC)
+        if sp == -1:
+            raise IRCBadMessage('No command on message: %r' % (raw,))
+        tags = line[1:sp]
+        match = _message_re.match(line, sp + 1)
     else:
-        prefix = None
-        command = parts[0]
-        args = parts[1:]
+        match = _message_re.match(line)
+    command = match.group(2)
+    if not command:
+        raise IRCBadMessage('No command on message: %r' % (raw,))
 
     if command.isdigit():
         try:
             command = numeric_to_symbolic[command]
         except KeyError:
-            logging.getLogger(__name__).warn(
-                'unknown numeric event %s' % command
-            )
-#    command = command.lower()
-    command = command.upper()
-
-    if args and args[0].startswith(ascii(":")):
-        args = [ascii(" ").join(args)[1:]]
+            log.warn('unknown numeric event %s', command)
+    else:
+        command = command.upper()
+
+    return IRCMessage(_UNPARSED, command, _UNPARSED, raw, tags, match)
+
+
+def _split_params(line, pos):
+    """
+    Split the parameters on ``line``, which start at ``pos``.
+    """
+    rest = line[pos:]
+    if not rest:
+        return []
+    elif rest[0] == ':':
+        return [rest[1:]]
+
+    # Middle parameters never hold " :", so the first one found starts
+    # the trailing parameter
+    sp = rest.find(' :')
+    if sp == -1:
+        params = rest.split(SPC)
     else:
-        for idx, arg in enumerate(args):
-            if arg.startswith(ascii(":")):
-                args = args[:idx] + [ascii(" ").join(args[idx:])[1:]]
+        params = rest[:sp].split(SPC)
+    if '' in params:
+        # Runs of spaces
+        params = [param for param in params if param]
+    if len(params) > 14:
+        return _parse_params(rest)
+    elif sp != -1:
+        params.append(rest[sp + 2:])
+    return params
+
+
+def _parse_params(line):
+    """
+    Parse the parameters on ``line`` one by one. Used for the rare messages
+    with more than 14 middle parameters since the 15th parameter is always
+    the trailing one.
+    """
+    pos, end = 0, len(line)
+    params = []
+    while pos < end:
+        if line[pos] == SPC:
+            pos += 1
+        elif line[pos] == ':':
+            params.append(line[pos + 1:])
+            break
+        elif len(params) == 14:
+            params.append(line[pos:])
+            break
+        else:
+            sp = line.find(SPC, pos)
+            if sp == -1:
+                params.append(line[pos:])
                 break
+            params.append(line[pos:sp])
+            pos = sp + 1
+    return params
+
+
+def parse_raw_irc_command(element):
+    """
+    This function parses a raw irc command and returns a tuple
+    of (prefix, command, args).
 
-    return (prefix, command, args)
+    See :func:`parse_irc_message`.
+    """
+    return parse_irc_message(element).as_tuple()
 
 def parse_netmask(netmask):
     """
@@ -342,6 +724,432 @@ def parse_netmask(netmask):
     return (nick, mode, user, host)
 
 
+def normalize_mask(mask):
+    """
+    Complete a ban like mask to the ``nick!user@host`` form, ie, ``nick``
+    becomes ``nick!*@*`` and ``user@host`` becomes ``*!user@host``.
+    """
+    if '!' not in mask:
+        if '@' in mask:
+            return '*!' + mask
+        return mask + '!*@*'
+    elif '@' not in mask:
+        return mask + '@*'
+    return mask
+
+
+class _CompiledMask(object):
+    __slots__ = ('mask', 'folded', 'regex', 'value')
+
+    def __init__(self, mask, folded, value):
+        self.mask = mask
+        self.folded = folded
+        self.value = value
+        pattern = ''.join([
+            char == '*' and '.*' or char == '?' and '.' or re.escape(char)
+            for char in folded
+        ])
+        self.regex = re.compile(pattern + r'\Z', re.DOTALL)
+
+
+class MaskMatcher(object):
+    """
+    Match netmasks against a set of ``nick!user@host`` wildcard masks, like
+    a channel's ban list, where ``*`` matches any number of characters and
+    ``?`` a single one.
+
+    Masks are folded, with a :class:`CaseFolder`, and compiled once, when
+    added. They're then indexed by the literal text they start or end with,
+    whichever is longer, so finding the masks a netmask matches only costs
+    a dictionary lookup for each distinct literal length in use and a
+    regular expression match for the masks found, no matter how many masks
+    there are. Masks without any literal start or end, ie, ``*!*@*``, are
+    checked one by one.
+
+    Masks can be added and removed one at a time, ie, as ``+b`` and ``-b``
+    mode changes arrive, see :meth:`apply_mode_change`.
+
+    :type fold: :class:`CaseFolder`
+    :param fold: How to fold masks and netmasks, usually the client's
+                 ``supported.fold``, defaults to ``rfc1459``.
+    """
+
+    def __init__(self, masks=(), fold=None):
+        self.fold = fold or CaseFolder.get()
+        self._masks = {}        # folded mask -> _CompiledMask
+        self._exact = {}        # folded mask without wildcards -> it
+        self._by_prefix = {}    # literal prefix -> {folded mask: it}
+        self._by_suffix = {}    # literal suffix -> {folded mask: it}
+        self._prefix_lengths = {}
+        self._suffix_lengths = {}
+        self._unindexed = {}
+        for mask in masks:
+            self.add(mask)
+
+    def __len__(self):
+        return len(self._masks)
+
+    def __contains__(self, mask):
+        return self.fold(normalize_mask(mask)) in self._masks
+
+    def __iter__(self):
+        return iter([compiled.mask for compiled in self._masks.itervalues()])
+
+    @staticmethod
+    def _literals(folded):
+        start = len(folded)
+        for idx, char in enumerate(folded):
+            if char in '*?':
+                start = idx
+                break
+        end = 0
+        for idx in xrange(len(folded) - 1, -1, -1):
+            if folded[idx] in '*?':
+                end = idx + 1
+                break
+        return folded[:start], folded[end:]
+
+    def _index_for(self, folded):
+        if '*' not in folded and '?' not in folded:
+            return self._exact, None, None
+        prefix, suffix = self._literals(folded)
+        if not prefix and not suffix:
+            return self._unindexed, None, None
+        elif len(suffix) >= len(prefix):
+            return self._by_suffix, self._suffix_lengths, suffix
+        return self._by_prefix, self._prefix_lengths, prefix
+
+    def add(self, mask, value=None):
+        """
+        Add ``mask``, and some ``value`` to keep along with it, ie, who set
+        it. Adding a mask which was already added replaces it's value.
+        """
+        mask = normalize_mask(mask)
+        folded = self.fold(mask)
+        compiled = _CompiledMask(mask, folded, value)
+        self.remove(mask)
+        self._masks[folded] = compiled
+        index, lengths, literal = self._index_for(folded)
+        if literal is None:
+            index[folded] = compiled
+        else:
+            index.setdefault(literal, {})[folded] = compiled
+            lengths[len(literal)] = lengths.get(len(literal), 0) + 1
+
+    def remove(self, mask):
+        """
+        Remove ``mask``, if it was added.
+        """
+        folded = self.fold(normalize_mask(mask))
+        if self._masks.pop(folded, None) is None:
+            return
+        index, lengths, literal = self._index_for(folded)
+        if literal is None:
+            del index[folded]
+            return
+        bucket = index[literal]
+        del bucket[folded]
+        if not bucket:
+            del index[literal]
+        length = len(literal)
+        if lengths[length] == 1:
+            del lengths[length]
+        else:
+            lengths[length] -= 1
+
+    def get_value(self, mask):
+        """
+        The value ``mask`` was added with.
+        """
+        compiled = self._masks.get(self.fold(normalize_mask(mask)))
+        if compiled is not None:
+            return compiled.value
+
+    def match(self, netmask):
+        """
+        The masks, as they were added, that ``netmask``, a ``str`` or an
+        :class:`~girclib.irc.IRCUser`, matches.
+
+        :rtype: ``list``
+        """
+        netmask = self.fold(getattr(netmask, 'netmask', netmask))
+        matches = []
+        compiled = self._exact.get(netmask)
+        if compiled is not None:
+            matches.append(compiled.mask)
+        size = len(netmask)
+        for index, lengths, prefix in (
+                (self._by_prefix, self._prefix_lengths, True),
+                (self._by_suffix, self._suffix_lengths, False)):
+            for length in lengths:
+                if length > size:
+                    continue
+                bucket = index.get(prefix and netmask[:length] or
+                                   netmask[size - length:])
+                if bucket is None:
+                    continue
+                for compiled in bucket.itervalues():
+                    if compiled.regex.match(netmask):
+                        matches.append(compiled.mask)
+        for compiled in self._unindexed.itervalues():
+            if compiled.regex.match(netmask):
+                matches.append(compiled.mask)
+        return matches
+
+    def matches(self, netmask):
+        """
+        Whether ``netmask`` matches any of the masks.
+        """
+        return bool(self.match(netmask))
+
+    def apply_mode_change(self, set, modes, args, list_mode='b', user=None):
+        """
+        Add or remove the masks of a mode change, as emitted by
+        :data:`~girclib.signals.on_mode_changed`, for ``list_mode``, ``b``
+        for bans, keeping the ``user`` who set them as their value.
+        """
+        for mode, mask in zip(modes, args):
+            if mode != list_mode or mask is None:
+                continue
+            if set:
+                self.add(mask, user)
+            else:
+                self.remove(mask)
+
+
+class LineFramer(object):
+    """
+    Incrementally split a stream of bytes into IRC lines.
+
+    Received data is appended to a single ``bytearray`` and a scan offset is
+    kept, so each byte is only looked at once no matter how small the pieces
+    the data arrives in are. Only complete lines are copied out of the buffer,
+    without their ``CR LF`` terminators, and lines longer than
+    ``max_length`` (which includes the terminators), plus ``tags_length`` if
+    they start with IRCv3 message tags, are truncated.
+
+    It's not tied to a socket, so captured traffic can be replayed with::
+
+        for line in LineFramer.replay(open('capture.log', 'rb')):
+            print parse_raw_irc_command(line)
+
+    :type max_length: ``int``
+    :param max_length: The maximum length of a line, including ``CR LF``.
+    :type tags_length: ``int``
+    :param tags_length: The maximum length of the message tags of a line.
+    """
+    # Compact the buffer once this many consumed bytes are in front of it
+    compact_threshold = 4096
+
+    def __init__(self, max_length=MAX_COMMAND_LENGTH,
+                 tags_length=MAX_TAGS_LENGTH):
+        self.max_length = max_length
+        self.tags_length = tags_length
+        self._buffer = bytearray()
+        self._start = 0         # Where the line being received starts
+        self._scan = 0          # Up to where we know there's no LF
+        self._discarding = False
+
+    def __len__(self):
+        """
+        The number of buffered bytes which are not yet part of a line.
+        """
+        return len(self._buffer) - self._start
+
+    def feed(self, data):
+        """
+        Feed received data to the framer.
+
+        :rtype: ``list`` of ``str``
+        :returns: The lines completed by ``data``.
+        """
+        buffer = self._buffer
+        buffer.extend(data)
+        view = memoryview(buffer)
+        start, scan = self._start, self._scan
+        limit = self.max_length - 2
+        tags_limit = limit + self.tags_length
+        lines = []
+        while True:
+            end = buffer.find(NL, scan)
+            if end == -1:
+                if len(buffer) - start > limit and not self._discarding:
+                    # Don't let a line without terminator grow forever
+                    # 64 is '@', which starts the message tags
+                    line_limit = buffer[start] == 64 and tags_limit or limit
+                    if len(buffer) - start > line_limit:
+                        log.warning("Truncating line longer than %d bytes",
+                                    line_limit + 2)
+                        lines.append(view[start:start + line_limit].tobytes())
+                        self._discarding = True
+                if self._discarding:
+                    start = len(buffer)
+                scan = len(buffer)
+                break
+
+            line_end = end
+            if line_end > start and buffer[line_end - 1] == 13:   # CR
+                line_end -= 1
+            if self._discarding:
+                self._discarding = False
+            elif line_end - start > limit and (
+                    buffer[start] != 64 or line_end - start > tags_limit):
+                # Too long, even if it's tagged
+                line_limit = buffer[start] == 64 and tags_limit or limit
+                log.warning("Truncating line longer than %d bytes",
+                            line_limit + 2)
+                lines.append(view[start:start + line_limit].tobytes())
+            elif line_end > start:
+                lines.append(view[start:line_end].tobytes())
+            start = scan = end + 1
+
+        del view
+        if start >= self.compact_threshold or start == len(buffer):
+            del buffer[:start]
+            scan -= start
+            start = 0
+        self._start, self._scan = start, scan
+        return lines
+
+    @classmethod
+    def replay(cls, fileobj, chunk_size=16384, **kwargs):
+        """
+        Iterate the lines on a file like object, ie, captured traffic.
+        """
+        framer = cls(**kwargs)
+        while True:
+            data = fileobj.read(chunk_size)
+            if not data:
+                break
+            for line in framer.feed(data):
+                yield line
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter.
+
+    The bucket holds up to ``burst`` tokens and is refilled with ``rate``
+    tokens per second. Sending something costs tokens, and once the bucket
+    runs dry senders have to wait for it to be refilled.
+
+    :type burst: ``float``
+    :param burst: The maximum number of tokens the bucket can hold.
+
+    :type rate: ``float``
+    :param rate: The number of tokens added to the bucket every second.
+
+    :raises ValueError: If ``burst`` or ``rate`` aren't positive, senders
+                        would wait forever.
+    """
+    def __init__(self, burst, rate, clock=time.time):
+        if burst <= 0 or rate <= 0:
+            raise ValueError("Token bucket burst and rate must be positive, "
+                             "not %r and %r" % (burst, rate))
+        self.burst = burst
+        self.rate = rate
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, cost):
+        """
+        The seconds to wait until ``cost`` tokens are available.
+
+        A ``cost`` above ``burst`` only waits for a full bucket.
+        """
+        self._refill()
+        cost = min(cost, self.burst)
+        if self.tokens >= cost:
+            return 0
+        return (cost - self.tokens) / float(self.rate)
+
+    def consume(self, cost):
+        """
+        Take ``cost`` tokens from the bucket, which might leave it in debt.
+        """
+        self._refill()
+        self.tokens -= cost
+
+
+def emits(*signals):
+    """
+    Decorator marking an ``irc_*`` handler whose only effect is emitting the
+    given signals, so that the messages it handles can be dropped, right after
+    their command is decoded, when none of those signals has receivers for the
+    client::
+
+        @emits(signals.on_joined, signals.on_user_joined)
+        def irc_JOIN(self, prefix, params):
+            ...
+    """
+    def decorator(handler):
+        handler._emits = signals
+        return handler
+    return decorator
+
+
+class _DispatchTableType(type):
+    """
+    Metaclass which builds, once per class, a table mapping command names to
+    handler functions for each of the handler prefixes the class lists in
+    ``_dispatch_prefixes``, plus it's ``prefix`` attribute if set.
+
+    For example, with ``_dispatch_prefixes = ('irc',)``, ``irc_PRIVMSG`` ends
+    up in ``cls._dispatch_tables['irc']['PRIVMSG']``. The tables hold plain
+    functions which should be called passing the instance as the first
+    argument.
+
+    Subclasses get their own tables, and handlers set on a class after it's
+    creation are picked up by it and it's subclasses. Handlers set on an
+    instance aren't on the tables, the dispatchers look them up when a
+    command isn't found on them.
+    """
+    def __init__(cls, name, bases, attrs):
+        super(_DispatchTableType, cls).__init__(name, bases, attrs)
+        cls._build_dispatch_tables()
+
+    def __setattr__(cls, name, value):
+        super(_DispatchTableType, cls).__setattr__(name, value)
+        if name.startswith(cls._handler_prefixes()):
+            cls._build_dispatch_tables()
+
+    def __delattr__(cls, name):
+        super(_DispatchTableType, cls).__delattr__(name)
+        if name.startswith(cls._handler_prefixes()):
+            cls._build_dispatch_tables()
+
+    def _handler_prefixes(cls):
+        prefixes = tuple(getattr(cls, '_dispatch_prefixes', ()))
+        if getattr(cls, 'prefix', None):
+            prefixes += (cls.prefix,)
+        return tuple(['%s_' % prefix for prefix in prefixes])
+
+    def _build_dispatch_tables(cls):
+        prefixes = cls._handler_prefixes()
+        tables = dict([(prefix[:-1], {}) for prefix in prefixes])
+        for name in dir(cls):
+            if not name.startswith(prefixes):
+                continue
+            handler = getattr(cls, name)
+            if not isinstance(handler, types.MethodType) or \
+                                                handler.im_self is not None:
+                # Only regular methods are handlers
+                continue
+            for prefix in prefixes:
+                if name.startswith(prefix):
+                    tables[prefix[:-1]][name[len(prefix):]] = handler.im_func
+        type.__setattr__(cls, '_dispatch_tables', tables)
+        for subclass in cls.__subclasses__():
+            subclass._build_dispatch_tables()
+
+
 class _CommandDispatcherMixin(object):
     """
     Dispatch commands to handlers based on their name.
@@ -356,27 +1164,29 @@ class _CommandDispatcherMixin(object):
     :type prefix: ``str``
     :ivar prefix: Command handler prefix, used to locate handler attributes
     """
+    __metaclass__ = _DispatchTableType
+
     prefix = None
 
     def dispatch(self, command_name, *args):
         """
         Perform actual command dispatch.
         """
-        def _get_method_name(command):
-            return '%s_%s' % (self.prefix, command)
-
-        def _get_method(name):
-            return getattr(self, _get_method_name(name), None)
-
-        method = _get_method(command_name)
+        handlers = self._dispatch_tables.get(self.prefix, {})
+        method = handlers.get(command_name)
         if method is not None:
-            return method(*args)
-
-        method = _get_method('unknown')
+            return method(self, *args)
+        if self.prefix:
+            # Maybe a handler set on the instance
+            method = getattr(self, '%s_%s' % (self.prefix, command_name), None)
+            if method is not None:
+                return method(*args)
+
+        method = handlers.get('unknown')
         if method is None:
             raise UnhandledCommand("No handler for %r could be found" %
-                                   (_get_method_name(command_name),))
-        return method(command_name, *args)
+                                   ('%s_%s' % (self.prefix, command_name),))
+        return method(self, command_name, *args)
 
 
 def setup_logging(format=None, level=5):
@@ -17,18 +17,23 @@ import gevent
 import socket
 import random
 import logging
+from collections import deque
 from gevent.dns import DNSError
 from gevent.event import Event
 from gevent.pool import Pool
-from gevent.socket import create_connection, wait_readwrite
+from gevent.queue import Queue
+from gevent.socket import create_connection, wait_read, wait_readwrite
 from string import letters, digits, punctuation
 from girclib import signals
+from girclib.gblinker import NamedSignal, inline
 from girclib.exceptions import IRCBadMessage, IRCBadModes, UnhandledCommand
 from girclib.helpers import (parse_modes, _int_or_default, split,
                              ctcp_stringify, ctcp_extract, X_DELIM,
                              CHANNEL_PREFIXES, MAX_COMMAND_LENGTH,
-                             parse_raw_irc_command, parse_netmask,
-                             _CommandDispatcherMixin)
+                             parse_irc_message, parse_netmask,
+                             LineFramer, TokenBucket, _CommandDispatcherMixin,
+                             _DispatchTableType, emits, format_message_tags,
+                             IRCMessage, CaseFolder, pack_targets)
 
 log = logging.getLogger(__name__)
 
@@ -45,13 +50,127 @@ def ascii(data):
     """Convert an ASCII string to a native string"""
     return bytes(data, encoding='ascii')
 
+def _socket_errno(err):
+    try:  # a little dance of compatibility to get the errno
+        return err.errno
+    except AttributeError:
+        return err[0]
+
+# Socket read modes
+READ_MODE_POLL  = 'poll'    # recv() once every ``poll_interval`` seconds
+READ_MODE_DRAIN = 'drain'   # wait for readiness and recv() until EAGAIN
+
+# Inbound line processing modes
+PROCESSING_ORDERED = 'ordered'  # one consumer greenlet, in protocol order
+PROCESSING_SPAWN   = 'spawn'    # one greenlet per received line
+
+# Outgoing lines priority lanes
+PRIORITY_HIGH   = 0     # never held back by flood control
+PRIORITY_NORMAL = 1
+PRIORITY_BULK   = 2
+PRIORITY_NAMES  = ('high', 'normal', 'bulk')
+
+# Priority lane for lines sent without an explicit priority, by command.
+# QUIT goes on the lowest lane so that it doesn't overtake, and lose, the
+# lines queued before it. PASS, CAP, NICK and USER are only sent on the high
+# priority lane while registering, see IRCProtocol.
+COMMAND_PRIORITIES = {
+    'PONG': PRIORITY_HIGH,
+    'PRIVMSG': PRIORITY_BULK,
+    'NOTICE': PRIORITY_BULK,
+    'QUIT': PRIORITY_BULK,
+}
+
+# The WHOX query IRCCommandsHelper.who() sends, token, channel, user name,
+# host, nick, flags, account and real name, and the token identifying it's
+# replies
+WHOX_TOKEN = '152'
+WHOX_QUERY = '%tcuhnfar,' + WHOX_TOKEN
+
+
+def _intern(value):
+    if value is not None:
+        return intern(value)
 
 class IRCUser(object):
+    """
+    A user, as found on a message prefix.
+
+    Users are immutable and shared, creating one for a netmask which was
+    seen recently returns the same object, with the nick, mode, user and
+    host strings interned, instead of parsing the netmask again.
+
+    The cache keeps up to ``cache_size`` recently seen netmasks on two
+    generations, when the newest fills up, the oldest is dropped and the
+    newest takes it's place, netmasks found on the oldest being moved back
+    to the newest, which is an approximation of a least recently used cache
+    that only costs a dictionary lookup on hits. See :meth:`cache_info`.
+    """
     __slots__ = ('netmask', 'nick', 'mode', 'user', 'host')
 
-    def __init__(self, netmask):
-        self.netmask = netmask
-        self.nick, self.mode, self.user, self.host = parse_netmask(netmask)
+    cache_size = 8192
+    _recent = {}
+    _older = {}
+    _hits = _misses = 0
+
+    def __new__(cls, netmask):
+        user = cls._recent.get(netmask)
+        if user is not None:
+            cls._hits += 1
+            return user
+
+        user = cls._older.pop(netmask, None)
+        if user is None:
+            cls._misses += 1
+            user = object.__new__(cls)
+            setattr_ = object.__setattr__
+            setattr_(user, 'netmask', netmask)
+            for name, value in zip(('nick', 'mode', 'user', 'host'),
+                                   parse_netmask(netmask)):
+                setattr_(user, name, _intern(value))
+        else:
+            cls._hits += 1
+
+        recent = cls._recent
+        if len(recent) >= cls.cache_size / 2:
+            cls._older = recent
+            cls._recent = recent = {}
+        recent[netmask] = user
+        return user
+
+    def __setattr__(self, name, value):
+        raise AttributeError("IRCUser objects are immutable")
+
+    __delattr__ = __setattr__
+
+    def __reduce__(self):
+        return (IRCUser, (self.netmask,))
+
+    @classmethod
+    def cache_info(cls):
+        """
+        The netmask cache statistics.
+
+        :rtype: ``dict``
+        :returns: The number of ``hits`` on, and ``misses`` of, the cache,
+                  ie, how many netmasks were parsed, it's current ``size`` and
+                  it's ``max_size``.
+        """
+        return {
+            'hits': cls._hits,
+            'misses': cls._misses,
+            'size': len(cls._recent) + len(cls._older),
+            'max_size': cls.cache_size
+        }
+
+    @classmethod
+    def clear_cache(cls):
+        """
+        Empty the netmask cache and reset it's statistics.
+        """
+        cls._recent = {}
+        cls._older = {}
+        cls._hits = cls._misses = 0
 
     def __repr__(self):
         return (
@@ -59,6 +178,21 @@ class IRCUser(object):
         ) % (self.nick, self.user, self.mode, self.host)
 
 
+class _Batch(object):
+    """
+    An IRCv3 batch which was started but did not end yet.
+    """
+    __slots__ = ('batch_type', 'params', 'messages', 'aggregate')
+
+    def __init__(self, batch_type, params, messages=None, aggregate=False):
+        self.batch_type = batch_type
+        self.params = params
+        # None when no one listens to on_batch
+        self.messages = messages
+        # Whether only on_batch delivers the messages
+        self.aggregate = aggregate
+
+
 class ConnectTimeout(Exception):
     pass
 
@@ -66,7 +200,57 @@ class IRCTransport(object):
     """
     IRC transport implementation, responsible for connecting, receiving and
     sending data to and from an IRC server.
+
+    How data is read from the socket can be tuned with the following class
+    attributes:
+
+    * **read_mode**: :data:`READ_MODE_DRAIN` (the default) blocks until the
+      socket is readable and then reads it until it would block.
+      :data:`READ_MODE_POLL` reads once every ``poll_interval`` seconds.
+    * **recv_size**: The number of bytes requested on each ``recv()`` call.
+    * **read_yield**: In drain mode, the seconds to sleep after draining the
+      socket, ``0`` just yields to other greenlets and ``None`` doesn't yield
+      at all.
+
+    Received lines are processed according to ``processing_mode``:
+
+    * :data:`PROCESSING_SPAWN` (the default) handles each line on it's own
+      greenlet.
+    * :data:`PROCESSING_ORDERED` queues lines on a queue of
+      ``inbound_queue_size`` lines which a single greenlet consumes, so lines
+      are handled in the order they were received. When handlers fall behind
+      and the queue fills up, the socket stops being read.
+
+      Emitting a signal waits for it's receivers, so in this mode a slow
+      receiver holds up every line after it, ``PING`` included, and a
+      receiver waiting for a later reply from the server, ie, on
+      :meth:`ChannelsResult.wait`, waits forever. Such receivers should
+      spawn a greenlet of their own to do it.
     """
+    read_mode     = READ_MODE_DRAIN
+    recv_size     = 16384
+    read_yield    = 0
+    poll_interval = 0.1
+
+    processing_mode    = PROCESSING_SPAWN
+    inbound_queue_size = 1000
+
+    # Outgoing lines are queued and written, in order, by a single greenlet
+    # which packs up to this many bytes of them into each socket write
+    write_budget = 4096
+
+    # Flood control, disabled by default. Each line costs 1 token plus
+    # ``flood_byte_cost`` tokens per byte, taken from a bucket holding up to
+    # ``flood_burst`` tokens which is refilled with ``flood_rate`` tokens per
+    # second, which must be positive. Lines on the high priority lane are
+    # never held back but still take their tokens. Set ``flood_control`` to
+    # ``True`` to enable it.
+    flood_control   = False
+    flood_burst     = 10
+    flood_rate      = 1.0
+    flood_byte_cost = 1 / 512.0
+    # Let other greenlets run after processing this many queued lines in a row
+    processing_yield_every = 100
 
     @classmethod
     def __new__(cls, *args, **kwargs):
@@ -97,54 +281,108 @@ class IRCTransport(object):
         self.network_host = network_host
         self.network_port = network_port
         self.use_ssl = use_ssl
+        # Reset the state a previous connection might have left behind
+        self._exited.clear()
+        self._joining_channels_possible.clear()
+        self._isupport_pending = False
+        if self.flood_control:
+            # Raises ValueError, before connecting, on a rate which would
+            # hold the writer back forever
+            self._flood_bucket = TokenBucket(self.flood_burst, self.flood_rate)
+        else:
+            self._flood_bucket = None
         log.debug("Connecting to %s:%s", self.network_host, self.network_port)
         try:
             if self.use_ssl:
                 from gevent.ssl import SSLSocket
                 log.warning("SSL support not properly tested yet")
                 self.socket = SSLSocket(
-                    create_connection((self.network_host, self.network_port))
+                    create_connection((self.network_host, self.network_port),
+                                      timeout=timeout)
                 )
             else:
                 self.socket = create_connection(
-                    (self.network_host, self.network_port)
+                    (self.network_host, self.network_port), timeout=timeout
                 )
         except DNSError, err:
             log.fatal("Failed to resolve DNS: %s", err)
-            signals.on_disconnected.send(self)
+            signals.on_disconnected.emit(self)
             return
         except socket.error, err:
             log.fatal("Unable to connect: %s", err)
-            signals.on_disconnected.send(self)
+            signals.on_disconnected.emit(self)
             return
 
         # Socket shouldn't be blocking because we're using gevent,
         # but, just in case...
         self.socket.setblocking(0)
-
-        gevent.spawn_raw(self.__read_socket)
-        gevent.spawn_raw(self.__connect_wait, timeout)
+        gevent.spawn_raw(self.__connect_wait, self.socket, timeout)
         return self._connected
 
-    def __connect_wait(self, timeout):
+    def __connect_wait(self, sock, timeout):
         try:
-            wait_readwrite(self.socket.fileno(), timeout=timeout,
+            wait_readwrite(sock.fileno(), timeout=timeout,
                            timeout_exc=ConnectTimeout())
         except ConnectTimeout:
             self._connected.clear()
             self._processing.clear()
             log.error("Timed out while trying to connect to %s:%s",
-                      self.host, self.port)
-            signals.on_disconnected.send(self)
+                      self.network_host, self.network_port)
+            sock.close()
+            signals.on_disconnected.emit(self)
         else:
+            # Each connection gets it's own queues and greenlets, which only
+            # ever touch the socket they were started for
+            self.__start_processing(sock)
             self._connected.set()
             self._processing.set()
-            signals.on_connected.send(self)
+            signals.on_connected.emit(self)
+
+    def __start_processing(self, sock):
+        self.framer = LineFramer()
+        if self.processing_mode == PROCESSING_ORDERED:
+            self._inbound = Queue(self.inbound_queue_size)
+            gevent.spawn_raw(self.__process_lines, self._inbound)
+
+        previous_ready = getattr(self, '_outbound_ready', None)
+        if previous_ready is not None:
+            # The previous connection's writer might still be waiting for
+            # lines, let it see that it's socket was replaced and exit
+            previous_ready.set()
+        self._outbound = tuple([deque() for name in PRIORITY_NAMES])
+        self._outbound_stats = [[0, 0.0, 0.0] for name in PRIORITY_NAMES]
+        self._outbound_ready = Event()
+        self._outbound_flushed = Event()
+        self._outbound_flushed.set()
+        gevent.spawn_raw(self.__write_socket, sock, self._outbound,
+                         self._outbound_ready)
+        gevent.spawn_raw(self.__read_socket, sock)
 
     def send(self, msg, *args, **kwargs):
+        """
+        Queue a line to be sent to the server.
+
+        ``msg`` is formatted with ``args`` and ``kwargs`` after they are
+        encoded.
+
+        The line goes into the ``priority`` lane passed as a keyword argument,
+        one of :data:`PRIORITY_HIGH`, :data:`PRIORITY_NORMAL` or
+        :data:`PRIORITY_BULK`, or, if not passed, the lane
+        :data:`COMMAND_PRIORITIES` defines for the line's command, normal
+        priority being the default.
+
+        IRCv3 message tags can be passed as a ``dict`` on the ``tags`` keyword
+        argument, see :func:`~girclib.helpers.format_message_tags`.
+        """
         if not self.processing:
             log.info("Not processing, so not sending any data.")
             return
+        priority = kwargs.pop('priority', None)
+        tags = kwargs.pop('tags', None)
+        if priority is None:
+            priority = COMMAND_PRIORITIES.get(
+                msg.split(ascii(' '), 1)[0].upper(), PRIORITY_NORMAL
+            )
         encoding = kwargs.get('encoding', self.encoding)
         bargs = []
         bkwargs = {}
@@ -173,8 +411,33 @@ class IRCTransport(object):
                 )
 
         msg = (msg.replace(ascii("%s"), ascii("%%s")) % bkwargs % tuple(bargs))
-        gevent.spawn_raw(self.__write_socket, msg + ascii("\r\n"))
-        gevent.sleep(0) # allow other greenlets to run
+        if tags:
+            msg = format_message_tags(tags) + msg
+        self._outbound[priority].append((time.time(), msg + ascii("\r\n")))
+        self._outbound_flushed.clear()
+        self._outbound_ready.set()
+
+    def get_outbound_stats(self):
+        """
+        Outgoing queue statistics.
+
+        :rtype: ``dict``
+        :returns: A dictionary keyed by priority lane name, ``high``,
+                  ``normal`` and ``bulk``, whose values are dictionaries with
+                  the number of lines ``queued`` and ``sent`` and the
+                  ``average_wait`` and ``max_wait`` seconds sent lines were
+                  queued for.
+        """
+        stats = {}
+        for idx, name in enumerate(PRIORITY_NAMES):
+            sent, total_wait, max_wait = self._outbound_stats[idx]
+            stats[name] = {
+                'queued': len(self._outbound[idx]),
+                'sent': sent,
+                'average_wait': sent and total_wait / sent or 0.0,
+                'max_wait': max_wait
+            }
+        return stats
 
     def disconnect(self):
         if not self.processing:
@@ -185,12 +448,13 @@ class IRCTransport(object):
         def on_quited(emitter):
             self._connected.clear()
             self._processing.clear()
+            self._outbound_ready.set()   # Let the writer exit
             if hasattr(self, 'socket'):
                 # Allow some time to stop recv socket
                 # gevent.sleep(1)
                 self.socket.close()
 
-            signals.on_disconnected.send(self)
+            signals.on_disconnected.emit(self)
             log.log(5, "Client disconnected")
             self._exited.set()
 
@@ -200,81 +464,178 @@ class IRCTransport(object):
         gevent.sleep(0)
         self.pool.join()
 
-    def __write_socket(self, data):
+    def __write_socket(self, sock, lanes, ready):
         self._connected.wait()
         self._processing.wait()
-        try:
-            log.debug("Writing Data: %r", data)
-            self.socket.send(data)
-        except socket.error, e:
-            try:  # a little dance of compatibility to get the errno
-                _errno = e.errno
-            except AttributeError:
-                _errno = e[0]
-            if _errno == errno.ECONNRESET:
-                # Server disconnected us
-                log.warning("Server disconnected us! Stop processing")
-                self._connected.clear()
-                self._processing.clear()
-                signals.on_disconnected.send(self)
-            elif _errno == errno.EPIPE:
-                # broken pipe. Server disconnected us???
-                log.warning("Broken socket pipe. Server disconnected us?! "
-                            "Stop processing")
-                self._connected.clear()
-                self._processing.clear()
-                signals.on_disconnected.send(self)
-            elif _errno == errno.EAGAIN:
-                # Socket not ready
-                log.warning("Socket not ready. Retrying on 0.2s")
-                gevent.spawn_later(0.2, self.__write_socket, data)
-            elif _errno == errno.EBADF:
-                # Bad file desctiptor. Socket closed!? Re-try just in case,
-                # if self._processing is False this wont run again...
-                log.warning("Bad file descriptor on socket. Retrying on 0.2s")
-                gevent.spawn_later(0.2, self.__write_socket, data)
-            else:
-                raise
-        except Exception, e:
-            self._connected.clear()
-            self._processing.clear()
-            signals.on_disconnected.send(self)
-            raise
+        while self.processing and sock is self.socket:
+            data, delay = self.__take_lines(lanes)
+            if not data:
+                ready.clear()
+                if delay is None:
+                    self._outbound_flushed.set()
+                # Flood control might be holding us back, but wake up as soon
+                # as something else is queued since it might be more urgent
+                ready.wait(delay)
+                continue
 
-    def __read_socket(self):
-        self._connected.wait()
-        self._processing.wait()
-        buffer = ascii('')
-        while self.processing:
+            data = ascii('').join(data)
             try:
-                buffer += self.socket.recv(MAX_COMMAND_LENGTH)
+                log.debug("Writing Data: %r", data)
+                # sendall() takes care of partial writes
+                sock.sendall(data)
             except socket.error, e:
-                try:  # a little dance of compatibility to get the errno
-                    _errno = e.errno
-                except AttributeError:
-                    _errno = e[0]
-                if _errno == errno.EAGAIN:
-                    # Socket not ready
-                    gevent.spawn_later(0.2, self.__read_socket)
-                    break
+                _errno = _socket_errno(e)
+                if _errno == errno.ECONNRESET:
+                    self._connection_lost("Server disconnected us!")
+                elif _errno == errno.EPIPE:
+                    self._connection_lost("Broken socket pipe. Server "
+                                          "disconnected us?!")
                 elif _errno == errno.EBADF:
-                    # Bad file desctiptor. Socket closed!? Re-try just in case,
-                    # if self._processing is False this wont run again...
-                    gevent.spawn_later(0.2, self.__read_socket)
+                    self._connection_lost("Bad file descriptor on socket!")
+                else:
+                    self._connection_lost("Socket error: %s." % e)
+                    raise
+                return
+            except Exception, e:
+                self._connection_lost("Failed to write to socket: %s." % e)
+                raise
+
+    def __take_lines(self, lanes):
+        """
+        Take the lines to be written next from the lanes, highest priority
+        first, within the write budget and what flood control allows.
+
+        :returns: ``(lines, delay)``, ``delay`` being the seconds until flood
+                  control allows the next line, ``0`` if it's the write
+                  budget that's exhausted or ``None`` if nothing's queued.
+        """
+        bucket = self._flood_bucket
+        now = time.time()
+        data = []
+        size = 0
+        for priority, lane in enumerate(lanes):
+            stats = self._outbound_stats[priority]
+            while lane:
+                queued_at, line = lane[0]
+                if data and size + len(line) > self.write_budget:
+                    return data, 0
+                if bucket is not None:
+                    cost = 1 + len(line) * self.flood_byte_cost
+                    if priority != PRIORITY_HIGH:
+                        delay = bucket.delay(cost)
+                        if delay:
+                            return data, delay
+                    bucket.consume(cost)
+                lane.popleft()
+                data.append(line)
+                size += len(line)
+                waited = now - queued_at
+                stats[0] += 1
+                stats[1] += waited
+                stats[2] = max(stats[2], waited)
+        return data, None
+
+    def flush(self, timeout=None):
+        """
+        Wait until the queued lines are written to the socket.
+
+        :type timeout: ``float``
+        :param timeout: The maximum number of seconds to wait.
+
+        :rtype: ``bool``
+        :returns: ``True`` if everything was written.
+        """
+        if not self.processing:
+            return not any(self._outbound)
+        return self._outbound_flushed.wait(timeout)
+
+    def __read_socket(self, sock):
+        self._connected.wait()
+        self._processing.wait()
+        if self.processing_mode == PROCESSING_ORDERED:
+            inbound = self._inbound
+            # Blocks when the queue is full, ie, stop reading the socket
+            # until the handlers catch up
+            handle_line = inbound.put
+        else:
+            inbound = None
+            handle_line = lambda line: gevent.spawn_raw(
+                self.on_data_available, line
+            )
+        try:
+            self.__read_lines(sock, handle_line)
+        finally:
+            if inbound is not None:
+                # Stop the consumer once it's done with what's queued
+                inbound.put(StopIteration)
+
+    def __read_lines(self, sock, handle_line):
+        framer = self.framer
+        while self.processing and sock is self.socket:
+            if self.read_mode == READ_MODE_DRAIN:
+                try:
+                    # Block until there's something to read instead of
+                    # polling the socket on a fixed interval
+                    wait_read(sock.fileno())
+                except socket.error, e:
+                    self._connection_lost("Socket error while waiting for "
+                                          "data: %s." % e)
+                    return
+            lines = []
+            lost = None
+            while True:
+                try:
+                    chunk = sock.recv(self.recv_size)
+                except socket.error, e:
+                    _errno = _socket_errno(e)
+                    if _errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        # Socket drained
+                        break
+                    elif _errno in (errno.ECONNRESET, errno.EBADF):
+                        lost = "Connection got reset!"
+                        break
+                    raise
+                if not chunk:
+                    lost = "Server closed the connection!"
                     break
-                elif _errno == errno.ECONNRESET:
-                    # Connection reset, we just got disconnected!?!?
-                    log.warning("Connection got reset???")
-                    gevent.spawn_later(0.2, self.__read_socket)
+                lines.extend(framer.feed(chunk))
+                if self.read_mode != READ_MODE_DRAIN:
                     break
-                else:
-                    raise e
-            else:
-                data = buffer.replace(ascii('\r'), ascii('')).split(ascii("\n"))
-                buffer = data.pop()
-                for el in data:
-                    gevent.spawn_raw(self.on_data_available, el)
-            gevent.sleep(0.1)   # Allow other greenlets to run
+
+            # Lines read before the connection was lost are handled too, ie,
+            # the server's closing ERROR
+            for line in lines:
+                handle_line(line)
+
+            if lost is not None:
+                self._connection_lost(lost)
+                return
+
+            if self.read_mode != READ_MODE_DRAIN:
+                gevent.sleep(self.poll_interval)
+            elif self.read_yield is not None:
+                gevent.sleep(self.read_yield)  # Allow other greenlets to run
+
+    def __process_lines(self, inbound):
+        processed = 0
+        for line in inbound:
+            try:
+                self.on_data_available(line)
+            except Exception, err:
+                log.exception(err)
+            processed += 1
+            if not processed % self.processing_yield_every:
+                gevent.sleep(0)     # Allow other greenlets to run
+
+    def _connection_lost(self, reason):
+        if not self.processing:
+            # We're the ones disconnecting or this was already handled
+            return
+        log.warning("%s Stop processing", reason)
+        self._connected.clear()
+        self._processing.clear()
+        self._outbound_ready.set()   # Let the writer exit
+        signals.on_disconnected.emit(self)
 
     def on_data_available(self, data):
         raise NotImplementedError
@@ -304,7 +665,60 @@ class ServerSupportedFeatures(_CommandDispatcherMixin):
             # CHANMODES, but we're defaulting it here to handle the case where
             # the IRC server doesn't send us any ISUPPORT information, since
             # IRCClient.getChannelModeParams relies on this value.
-            'CHANMODES': self._parse_chan_modes_param(['b', '', 'lk'])}
+            'CHANMODES': self._parse_chan_modes_param(['b', '', 'lk']),
+            'CASEMAPPING': 'rfc1459'}
+        # Folds nicks and channel names according to CASEMAPPING, see
+        # girclib.helpers.CaseFolder, it's table is available as
+        # ``fold.table``
+        self.fold = CaseFolder.get('rfc1459')
+        self._classify_channel_modes()
+
+    def _classify_channel_modes(self):
+        """
+        Classify the channel modes, from ``PREFIX`` and ``CHANMODES``, so
+        that it's done once per ``ISUPPORT`` update instead of for each
+        ``MODE`` message.
+
+        Sets:
+
+        * ``channel_mode_kinds``, a ``dict`` mapping each channel mode to
+          ``'prefix'`` or to it's ``CHANMODES`` category, see
+          :meth:`isupport_CHANMODES`.
+        * ``channel_param_modes``, the ``(set, unset)`` strings of the modes
+          taking a parameter when set and when unset, as
+          :func:`~girclib.helpers.parse_modes` takes them.
+        * ``prefix_bits``, mapping membership modes to ``1 << priority`` bit
+          flags.
+        * ``prefix_symbols``, mapping membership mode symbols, like ``@``,
+          to their modes.
+        * ``prefix_modes``, the membership modes, highest first, as
+          ``(bit, mode)`` tuples.
+        """
+        prefixes = self.get_feature('PREFIX') or {}
+        chanmodes = self.get_feature('CHANMODES') or {}
+        kinds = {}
+        for kind in ('noParam', 'setParam', 'param', 'addressModes'):
+            for mode in chanmodes.get(kind, ''):
+                kinds[mode] = kind
+        for mode in prefixes:
+            kinds[mode] = 'prefix'
+        self.channel_mode_kinds = kinds
+
+        unset = ''.join(prefixes.iterkeys()) + \
+            chanmodes.get('addressModes', '') + chanmodes.get('param', '')
+        self.channel_param_modes = (unset + chanmodes.get('setParam', ''),
+                                    unset)
+
+        self.prefix_bits = dict([
+            (mode, 1 << priority)
+            for mode, (symbol, priority) in prefixes.iteritems()
+        ])
+        self.prefix_symbols = dict([
+            (symbol, mode) for mode, (symbol, priority) in prefixes.iteritems()
+        ])
+        self.prefix_modes = sorted([
+            (bit, mode) for mode, bit in self.prefix_bits.iteritems()
+        ])
 
     @classmethod
     def _split_param_args(cls, params, value_processor=None):
@@ -460,12 +874,18 @@ class ServerSupportedFeatures(_CommandDispatcherMixin):
         :type params: ``iterable`` of ``str``
         :param params: Iterable of ISUPPORT parameters to parse
         """
+        classify = False
         for param in params:
             key, value = self._split_param(param)
             if key.startswith('-'):
-                self._features.pop(key[1:], None)
+                key = key[1:]
+                self._features.pop(key, None)
             else:
                 self._features[key] = self.dispatch(key, value)
+            if key in ('PREFIX', 'CHANMODES'):
+                classify = True
+        if classify:
+            self._classify_channel_modes()
 
 
     def isupport_unknown(self, command, params):
@@ -475,6 +895,15 @@ class ServerSupportedFeatures(_CommandDispatcherMixin):
         return tuple(params)
 
 
+    def isupport_CASEMAPPING(self, params):
+        """
+        How the server folds the case of nicks and channel names, see
+        :class:`~girclib.helpers.CaseFolder`.
+        """
+        casemapping = params[0] or 'rfc1459'
+        self.fold = CaseFolder.get(casemapping)
+        return casemapping
+
     def isupport_CHANLIMIT(self, params):
         """
         The maximum number of each channel type a user may join.
@@ -645,12 +1074,67 @@ class ServerSupportedFeatures(_CommandDispatcherMixin):
 
 
 class IRCProtocol(IRCTransport):
+    __metaclass__ = _DispatchTableType
+    _dispatch_prefixes = ('irc', 'ctcp_query', 'ctcp_reply')
 
     _pings = None
     _MAX_PINGRING = 12
     _attempted_nick = None
+    _isupport_pending = False
+    _registered = False
+    _available_capabilities = frozenset()
+    _batches = None
+    _names = None
+    # Our own ``user@host``, as the server puts it on the messages it relays
+    # from us, once seen
+    _userhost = None
 
     motd = None
+    # The IRCv3 message tags of the message being handled, or the message
+    # they're still to be parsed from
+    _message_tags = None
+
+    # The IRCv3 capabilities to request, when the server supports them, while
+    # connecting, and the ones enabled for the connection
+    request_capabilities = ('batch', 'multi-prefix')
+    capabilities = frozenset()
+    # Whether messages in a batch still emit their own signals when the
+    # batch is delivered as a whole by on_batch
+    batch_item_delivery = False
+
+    @property
+    def _registration_priority(self):
+        # Registration isn't held back by flood control, the same commands
+        # sent once registered are
+        if self._registered:
+            return None
+        return PRIORITY_HIGH
+
+    @property
+    def message_tags(self):
+        """
+        The IRCv3 message tags of the message being handled, ``None`` if it
+        has none. Only reliable with ``PROCESSING_ORDERED``.
+        """
+        tags = self._message_tags
+        if tags is not None and not isinstance(tags, dict):
+            # Parsed once first read
+            tags = self._message_tags = tags.tags
+        return tags
+
+    def connect(self, network_host, network_port=6667, use_ssl=False,
+                timeout=30):
+        # The capabilities and batches of a previous connection don't apply
+        # to this one
+        self._registered = False
+        self.capabilities = set()
+        self._available_capabilities = set()
+        self._batches = {}
+        self._names = None
+        self._userhost = None
+        return IRCTransport.connect(self, network_host, network_port,
+                                    use_ssl=use_ssl, timeout=timeout)
+
     # ---- CTCP Abstraction Start ----------------------------------------------
     userinfo     = None
 
@@ -658,18 +1142,24 @@ class IRCProtocol(IRCTransport):
         """
         Dispatch method for any CTCP queries received.
         """
+        handlers = self._dispatch_tables['ctcp_query']
         for m in messages:
-            method = getattr(self, "ctcp_query_%s" % m[0], None)
+            method = handlers.get(m[0])
+            if method:
+                method(self, user, channel, m[1])
+                continue
+            # Maybe a handler set on the instance
+            method = getattr(self, 'ctcp_query_%s' % m[0], None)
             if method:
                 method(user, channel, m[1])
             else:
                 self.ctcp_unknown_query(user, channel, m[0], m[1])
 
     def ctcp_query_ACTION(self, user, channel, data):
-        signals.on_action.send(self, user=user, channel=channel, data=data)
+        signals.on_action.emit(self, user=user, channel=channel, data=data)
 
     def ctcp_query_PING(self, user, channel, data):
-        signals.on_ctcp_query_ping.send(
+        signals.on_ctcp_query_ping.emit(
             self, user=user, channel=channel, data=data
         )
 
@@ -679,7 +1169,7 @@ class IRCProtocol(IRCTransport):
                 "Why did %s send '%s' with a FINGER query?" % (user, data)
             )
 
-        signals.on_ctcp_query_finger.send(
+        signals.on_ctcp_query_finger.emit(
             self, user=user, channel=channel, data=data
         )
 
@@ -689,7 +1179,7 @@ class IRCProtocol(IRCTransport):
                 "Why did %s send '%s' with a VERSION query?" % (user, data)
             )
 
-        signals.on_ctcp_query_version.send(
+        signals.on_ctcp_query_version.emit(
             self, user=user, channel=channel, data=data
         )
 
@@ -698,7 +1188,7 @@ class IRCProtocol(IRCTransport):
             self.quirky_message(
                 "Why did %s send '%s' with a SOURCE query?" % (user, data)
             )
-        signals.on_ctcp_query_source.send(
+        signals.on_ctcp_query_source.emit(
             self, user=user, channel=channel, data=data
         )
 
@@ -717,21 +1207,14 @@ class IRCProtocol(IRCTransport):
         If an argument is provided, provide human-readable help on
         the usage of that tag.
         """
+        handlers = self._dispatch_tables['ctcp_query']
         if not data:
-            names = []
-            for name in dir(self):
-                if not name.startswith('ctcp_query_'):
-                    continue
-                elif not callable(getattr(self, name)):
-                    continue
-                names.append(name.lstrip('ctcp_query_'))
-
             self.ctcp_make_reply(user, [
-                ('CLIENTINFO', ascii(' ').join(names))
+                ('CLIENTINFO', ascii(' ').join(sorted(handlers)))
             ])
         else:
             args = data.split(ascii('\n'))
-            method = getattr(self, 'ctcp_query_%s' % (args[0],), None)
+            method = handlers.get(args[0])
             if not method:
                 self.ctcp_make_reply(user, [
                     ('ERRMSG', "CLIENTINFO %s :" "Unknown query '%s'"
@@ -793,8 +1276,14 @@ class IRCProtocol(IRCTransport):
         """
         Dispatch method for any CTCP replies received.
         """
+        handlers = self._dispatch_tables['ctcp_reply']
         for msg in messages:
-            method = getattr(self, "ctcp_reply_%s" % msg[0], None)
+            method = handlers.get(msg[0])
+            if method:
+                method(self, user, channel, msg[1])
+                continue
+            # Maybe a handler set on the instance
+            method = getattr(self, 'ctcp_reply_%s' % msg[0], None)
             if method:
                 method(user, channel, msg[1])
             else:
@@ -827,6 +1316,13 @@ class IRCProtocol(IRCTransport):
         """
         log.warn("Quirky Message: \"%s\"", msg)
 
+    def is_nickname(self, nick):
+        """
+        Whether ``nick`` is this client's nickname, according to the server's
+        ``CASEMAPPING``.
+        """
+        return self.supported.fold.equals(nick, self.nickname)
+
     # ---- IRC Abstraction Start -----------------------------------------------
     def irc_ERR_NICKNAMEINUSE(self, prefix, params):
         """
@@ -835,7 +1331,7 @@ class IRCProtocol(IRCTransport):
         """
         # TODO: signals
         log.warn("Nickname %r already in use!", self._attempted_nick)
-        signals.on_nickname_in_use.send(self, nickname=self._attempted_nick)
+        signals.on_nickname_in_use.emit(self, nickname=self._attempted_nick)
 
     def irc_ERR_ERRONEUSNICKNAME(self, prefix, params):
         """
@@ -851,14 +1347,14 @@ class IRCProtocol(IRCTransport):
         """
         # TODO: signals
         log.warn("Tried to set a nick to an invalid nick. Setting it to fallback")
-        signals.on_erroneous_nickname.send(self, nickname=self._attempted_nick)
+        signals.on_erroneous_nickname.emit(self, nickname=self._attempted_nick)
 
     def irc_ERR_PASSWDMISMATCH(self, prefix, params):
         """
         Called when the login was incorrect.
         """
         log.error("Your login was incorrect!")
-        signals.on_password_mismatch.send(self)
+        signals.on_password_mismatch.emit(self)
 
     def irc_ERR_NOTREGISTERED(self, prefix, params):
         """
@@ -866,17 +1362,99 @@ class IRCProtocol(IRCTransport):
         """
         log.warn(params[-1])
 
+    def _channel_error(self, error, params):
+        channel = params[1]
+        message = params[-1]
+        log.info("%s for %r: %s", error, channel, message)
+        signals.on_channel_error.emit(self, channel=channel, error=error,
+                                      message=message)
+
+    @emits(signals.on_channel_error)
+    def irc_ERR_NOSUCHCHANNEL(self, prefix, params):
+        """
+        The channel name is not valid, or, when leaving it, doesn't exist.
+        """
+        self._channel_error('ERR_NOSUCHCHANNEL', params)
+
+    @emits(signals.on_channel_error)
+    def irc_ERR_TOOMANYCHANNELS(self, prefix, params):
+        """
+        Joining the channel would exceed the number of channels we may be on.
+        """
+        self._channel_error('ERR_TOOMANYCHANNELS', params)
+
+    @emits(signals.on_channel_error)
+    def irc_ERR_TOOMANYTARGETS(self, prefix, params):
+        """
+        Too many channels were given at once, or another channel with the same
+        short name exists.
+        """
+        self._channel_error('ERR_TOOMANYTARGETS', params)
+
+    @emits(signals.on_channel_error)
+    def irc_ERR_UNAVAILRESOURCE(self, prefix, params):
+        """
+        The channel is temporarily unavailable, ie, after a netsplit.
+        """
+        self._channel_error('ERR_UNAVAILRESOURCE', params)
+
+    @emits(signals.on_channel_error)
+    def irc_ERR_NOTONCHANNEL(self, prefix, params):
+        """
+        We tried to leave, or act on, a channel we're not on.
+        """
+        self._channel_error('ERR_NOTONCHANNEL', params)
+
+    @emits(signals.on_channel_error)
+    def irc_ERR_CHANNELISFULL(self, prefix, params):
+        """
+        The channel is full, it's ``l`` mode limit was reached.
+        """
+        self._channel_error('ERR_CHANNELISFULL', params)
+
+    @emits(signals.on_channel_error)
+    def irc_ERR_INVITEONLYCHAN(self, prefix, params):
+        """
+        The channel is invite only, it has the ``i`` mode set.
+        """
+        self._channel_error('ERR_INVITEONLYCHAN', params)
+
+    @emits(signals.on_channel_error)
+    def irc_ERR_BADCHANNELKEY(self, prefix, params):
+        """
+        The channel key was missing or wrong.
+        """
+        self._channel_error('ERR_BADCHANNELKEY', params)
+
+    @emits(signals.on_channel_error)
+    def irc_ERR_BADCHANMASK(self, prefix, params):
+        """
+        The channel name is not valid.
+        """
+        self._channel_error('ERR_BADCHANMASK', params)
+
+    @emits(signals.on_channel_error)
+    def irc_ERR_NOCHANMODES(self, prefix, params):
+        """
+        The channel doesn't support modes, or, on several networks, it's only
+        for registered users.
+        """
+        self._channel_error('ERR_NOCHANMODES', params)
+
     def irc_ERR_BANNEDFROMCHAN(self, prefix, params):
         nick = params[0]
         channel = params[1]
         message = params[2]
         log.error("Nick %r banned from channel %r: %s", nick, channel, message)
-        if nick == self.nickname:
-            signals.on_banned.send(
+        signals.on_channel_error.emit(self, channel=channel,
+                                      error='ERR_BANNEDFROMCHAN',
+                                      message=message)
+        if self.is_nickname(nick):
+            signals.on_banned.emit(
                 self, channel=channel, message=message
             )
         else:
-            signals.on_user_banned.send(
+            signals.on_user_banned.emit(
                 self, channel=channel, user=nick, message=message
             )
 
@@ -885,88 +1463,123 @@ class IRCProtocol(IRCTransport):
         Called when we have received the welcome from the server.
         """
         self._joining_channels_possible.set()
-        signals.on_rpl_welcome.send(self, message=params[1])
+        signals.on_rpl_welcome.emit(self, message=params[1])
         self._registered = True
         self.nickname = self._attempted_nick
-        signals.on_signed_on.send(self)
+        # Most servers welcome us by our full nick!user@host
+        netmask = params[-1].rsplit(' ', 1)[-1]
+        if '!' in netmask and '@' in netmask:
+            self._userhost = netmask.split('!', 1)[1]
+        signals.on_signed_on.emit(self)
 
     def irc_JOIN(self, prefix, params):
         """
         Called when a user joins a channel.
+
+        Our own joins also tell us our ``user@host``, see
+        :meth:`get_prefix_length`, so the message is always handled, even
+        when nothing listens to the join signals.
         """
         user = IRCUser(prefix)
         channel = params[-1]
-        if user.nick == self.nickname:
-            signals.on_joined.send(self, channel=channel)
+        if self.is_nickname(user.nick):
+            self._userhost = '%s@%s' % (user.user, user.host)
+            signals.on_joined.emit(self, channel=channel)
         else:
-            signals.on_user_joined.send(self, channel=channel, user=user)
+            signals.on_user_joined.emit(self, channel=channel, user=user)
 
+    @emits(signals.on_left, signals.on_user_left)
     def irc_PART(self, prefix, params):
         """
         Called when a user leaves a channel.
         """
         user = IRCUser(prefix)
         channel = params[0]
-        if user.nick == self.nickname:
-            signals.on_left.send(self, channel=channel)
+        if self.is_nickname(user.nick):
+            signals.on_left.emit(self, channel=channel)
         else:
-            signals.on_user_left.send(self, channel=channel, user=user)
+            signals.on_user_left.emit(self, channel=channel, user=user)
 
+    @emits(signals.on_user_quit)
     def irc_QUIT(self, prefix, params):
         """
         Called when a user has quit.
         """
         user = IRCUser(prefix)
-        signals.on_user_quit.send(self, user=user, message=params[0])
+        signals.on_user_quit.emit(self, user=user, message=params[0])
 
 
+    @emits(signals.on_mode_changed)
     def irc_MODE(self, prefix, params):
         """
         Parse a server mode change message.
         """
         user = IRCUser(prefix)
-        channel, modes, args = params[0], params[1], params[2:]
-
-        if modes[0] not in '-+':
-            modes = '+' + modes
-
-
-        # Mode change to our individual user, not a channel mode
-        # that involves us.
-        param_modes = ['', '']
-
-        if channel != self.nickname:
-            # This is a mode change to a channel
-            prefixes = self.supported.get_feature('PREFIX', {})
-            param_modes[0] = param_modes[1] = ''.join(prefixes.iterkeys())
-
-            chanmodes = self.supported.get_feature('CHANMODES')
-            if chanmodes is not None:
-                param_modes[0] += chanmodes.get('addressModes', '')
-                param_modes[0] += chanmodes.get('param', '')
-                param_modes[1] = param_modes[0]
-                param_modes[0] += chanmodes.get('setParam', '')
-
         try:
-            added, removed = parse_modes(modes, args, param_modes)
+            channel, added, removed = self.parse_mode_change(params)
         except IRCBadModes:
             log.error('An error occured while parsing the following MODE '
                       'message: MODE %s', ' '.join(params))
         else:
             if added:
                 modes, params = zip(*added)
-                signals.on_mode_changed.send(
+                signals.on_mode_changed.emit(
                     self, user=user, channel=channel,
                     set=True, modes=ascii('').join(modes), args=params
                 )
 
             if removed:
                 modes, params = zip(*removed)
-                signals.on_mode_changed.send(
+                signals.on_mode_changed.emit(
                     self, user=user, channel=channel,
                     set=False, modes=ascii('').join(modes), args=params
                 )
 
+    def get_prefix_length(self):
+        """
+        The length of the ``:nick!user@host`` prefix, and the space after it,
+        the server puts on the messages it relays from us, which count
+        towards ``MAX_COMMAND_LENGTH`` too.
+
+        Until our own ``user@host`` is seen, on the welcome message or when
+        joining a channel, the longest the server's ``USERLEN`` and
+        ``HOSTLEN``, or their usual defaults, allow is assumed.
+        """
+        if self._userhost is not None:
+            userhost = len(self._userhost)
+        else:
+            userlen = self.supported.get_feature('USERLEN') or ('',)
+            hostlen = self.supported.get_feature('HOSTLEN') or ('',)
+            # The user name may get a ``~`` prepended
+            userhost = _int_or_default(userlen[0], 10) + 2 + \
+                _int_or_default(hostlen[0], 63)
+        return len(self.nickname or '') + userhost + 3
+
+    def parse_mode_change(self, params):
+        """
+        Parse the parameters of a ``MODE`` message.
+
+        :returns: The ``(target, added, removed)`` tuple, see
+                  :func:`~girclib.helpers.parse_modes`.
+        :raises: :class:`~girclib.exceptions.IRCBadModes`
+        """
+        channel, modes, args = params[0], params[1], params[2:]
+
+        if modes[0] not in '-+':
+            modes = '+' + modes
+
+        if self.is_nickname(channel):
+            # Mode change to our individual user, not a channel mode
+            # that involves us.
+            param_modes = ('', '')
+        else:
+            # This is a mode change to a channel, which modes take
+            # parameters was worked out when ISUPPORT was parsed
+            param_modes = self.supported.channel_param_modes
+
+        added, removed = parse_modes(modes, args, param_modes)
+        return channel, added, removed
+
 
     def irc_PING(self, prefix, params):
         """
@@ -1003,10 +1616,10 @@ class IRCProtocol(IRCTransport):
                 return
 
             message = ascii(' ').join(m['normal'])
-        if channel == self.nickname:
-            signals.on_privmsg.send(self, user=user, message=message)
+        if self.is_nickname(channel):
+            signals.on_privmsg.emit(self, user=user, message=message)
         else:
-            signals.on_chanmsg.send(self, channel=channel, user=user,
+            signals.on_chanmsg.emit(self, channel=channel, user=user,
                                     message=message)
 
     def irc_NOTICE(self, prefix, params):
@@ -1026,18 +1639,20 @@ class IRCProtocol(IRCTransport):
                 return
             message = ascii(' ').join(m['normal'])
 
-        signals.on_notice.send(self, user=user, channel=channel, message=message)
+        signals.on_notice.emit(self, user=user, channel=channel, message=message)
 
     def irc_NICK(self, prefix, params):
         """
         Called when a user changes their nickname.
         """
         user = IRCUser(prefix)
-        if user.nick == self.nickname:
-            signals.on_nick_changed.send(self, user=user, newnick=params[0])
+        if self.is_nickname(user.nick):
+            self.nickname = params[0]
+            signals.on_nick_changed.emit(self, user=user, newnick=params[0])
         else:
-            signals.on_user_renamed.send(self, user=user, newnick=params[0])
+            signals.on_user_renamed.emit(self, user=user, newnick=params[0])
 
+    @emits(signals.on_kicked, signals.on_user_kicked)
     def irc_KICK(self, prefix, params):
         """
         Called when a user is kicked from a channel.
@@ -1046,14 +1661,15 @@ class IRCProtocol(IRCTransport):
         channel = params[0]
         kicked = params[1]
         message = params[-1]
-        if ascii(kicked).lower() == ascii(self.nickname).lower():
+        if self.is_nickname(kicked):
             # Yikes!
-            signals.on_kicked.send(self, channel=channel, kicker=kicker,
+            signals.on_kicked.emit(self, channel=channel, kicker=kicker,
                                    message=message)
         else:
-            signals.on_user_kicked.send(self, channel=channel, kicked=kicked,
+            signals.on_user_kicked.emit(self, channel=channel, kicked=kicked,
                                         kicker=kicker, message=message)
 
+    @emits(signals.on_topic_changed)
     def irc_TOPIC(self, prefix, params):
         """
         Someone in the channel set the topic.
@@ -1061,9 +1677,10 @@ class IRCProtocol(IRCTransport):
         user = IRCUser(prefix)
         channel = params[0]
         newtopic = params[1]
-        signals.on_topic_changed.send(self, user=user, channel=channel,
+        signals.on_topic_changed.emit(self, user=user, channel=channel,
                                       new_topic=newtopic)
 
+    @emits(signals.on_rpl_topic)
     def irc_RPL_TOPIC(self, prefix, params):
         """
         Called when the topic for a channel is initially reported or when it
@@ -1072,15 +1689,64 @@ class IRCProtocol(IRCTransport):
         user = IRCUser(prefix)
         channel = params[1]
         newtopic = params[2]
-        signals.on_rpl_topic.send(self, user=user, channel=channel,
+        signals.on_rpl_topic.emit(self, user=user, channel=channel,
                                   new_topic=newtopic)
 
+    @emits(signals.on_rpl_notopic)
     def irc_RPL_NOTOPIC(self, prefix, params):
         """
         Called when no topic for a channel is set.
         """
         channel = params[1]
-        signals.on_rpl_notopic.send(self, channel=channel)
+        signals.on_rpl_notopic.emit(self, channel=channel)
+
+    @emits(signals.on_rpl_channelmodeis)
+    def irc_RPL_CHANNELMODEIS(self, prefix, params):
+        """
+        Called with the modes currently set on a channel.
+        """
+        try:
+            channel, added, removed = self.parse_mode_change(params[1:])
+        except IRCBadModes:
+            log.error('An error occured while parsing the following '
+                      'RPL_CHANNELMODEIS message: %s', ' '.join(params))
+            return
+        if added:
+            modes, args = zip(*added)
+        else:
+            modes, args = (), ()
+        signals.on_rpl_channelmodeis.emit(
+            self, channel=channel, modes=ascii('').join(modes), args=args
+        )
+
+    @emits(signals.on_rpl_banlist)
+    def irc_RPL_BANLIST(self, prefix, params, mode='b'):
+        """
+        Called for each entry of a channel's ban list.
+        """
+        channel, mask = params[1], params[2]
+        setter = len(params) > 3 and params[3] or None
+        set_at = len(params) > 4 and _int_or_default(params[4]) or None
+        signals.on_rpl_banlist.emit(self, channel=channel, mode=mode,
+                                    mask=mask, setter=setter, set_at=set_at)
+
+    @emits(signals.on_rpl_banlist)
+    def irc_RPL_EXCEPTLIST(self, prefix, params):
+        """
+        Called for each entry of a channel's ban exceptions list.
+        """
+        self.irc_RPL_BANLIST(
+            prefix, params, mode=self.supported.get_feature('EXCEPTS') or 'e'
+        )
+
+    @emits(signals.on_rpl_banlist)
+    def irc_RPL_INVITELIST(self, prefix, params):
+        """
+        Called for each entry of a channel's invite exceptions list.
+        """
+        self.irc_RPL_BANLIST(
+            prefix, params, mode=self.supported.get_feature('INVEX') or 'I'
+        )
 
     def irc_RPL_MOTDSTART(self, prefix, params):
         """
@@ -1103,21 +1769,31 @@ class IRCProtocol(IRCTransport):
         """
         motd = self.motd
         self.motd = None    # Restore motd to None
-        signals.on_motd.send(self, motd=motd)
+        signals.on_motd.emit(self, motd=motd)
 
+    def irc_ERR_NOMOTD(self, prefix, params):
+        """
+        ``ERR_NOMOTD`` replaces the message of the day when there's none.
+        """
+        self.motd = None
+        signals.on_motd.emit(self, motd=[])
+
+    @emits(signals.on_rpl_created)
     def irc_RPL_CREATED(self, prefix, params):
         """
         This is called to tell when the server was created.
         """
-        signals.on_rpl_created.send(self, when=params[1])
+        signals.on_rpl_created.emit(self, when=params[1])
 
+    @emits(signals.on_rpl_yourhost)
     def irc_RPL_YOURHOST(self, prefix, params):
         """
         This is called to tell to which server we're connected to and
         it's version.
         """
-        signals.on_rpl_yourhost.send(self, info=params[1])
+        signals.on_rpl_yourhost.emit(self, info=params[1])
 
+    @emits(signals.on_rpl_myinfo)
     def irc_RPL_MYINFO(self, prefix, params):
         """
         This is called upon a successful registration.
@@ -1125,9 +1801,10 @@ class IRCProtocol(IRCTransport):
         info = params[1].split(None, 3)
         while len(info) < 4:
             info.append(None)
-        signals.on_rpl_myinfo.send(self, servername=info[0], version=info[1],
+        signals.on_rpl_myinfo.emit(self, servername=info[0], version=info[1],
                                    umodes=info[2], cmodes=info[3])
 
+    @emits(signals.on_rpl_bounce)
     def irc_RPL_BOUNCE(self, prefix, params):
         """
         This is sent by the server to a user to suggest an alternative server.
@@ -1135,7 +1812,7 @@ class IRCProtocol(IRCTransport):
         already full.
         """
         # XXX: Shoult we handle this ourselves and connect to the server provided???
-        signals.on_rpl_bounce.send(self, info=params[1])
+        signals.on_rpl_bounce.emit(self, info=params[1])
 
     def irc_RPL_ISUPPORT(self, prefix, params):
         args = params[1:-1]
@@ -1144,108 +1821,370 @@ class IRCProtocol(IRCTransport):
         # though.) For this reason, ServerSupportedFeatures.parse is intended
         # to mutate the supported feature list.
         self.supported.parse(args)
-
-        if getattr(self, '_isupport_ready_event', None) is None:
-            # Special case so that we only issue on_rpl_isupport once we
-            # have all issuport options
-            self._isupport_ready_event = Event()
-            self._isupport_ready_event.wait()
-            signals.on_rpl_isupport.send(self, options=self.supported._features)
-            del self._isupport_ready_event
+        # Special case so that we only issue on_rpl_isupport once we
+        # have all issuport options, see handle_command()
+        self._isupport_pending = True
 
 
+    @emits(signals.on_rpl_luserclient)
     def irc_RPL_LUSERCLIENT(self, prefix, params):
         """
         This tells us how many clients, services and servers are connected.
         """
-        signals.on_rpl_luserclient.send(self, info=params[1])
+        signals.on_rpl_luserclient.emit(self, info=params[1])
 
+    @emits(signals.on_rpl_luserop)
     def irc_RPL_LUSEROP(self, prefix, params):
         """
         This tells us how many operators are connected.
         """
         try:
-            signals.on_rpl_luserop.send(self, ops=int(params[1]))
+            signals.on_rpl_luserop.emit(self, ops=int(params[1]))
         except ValueError:
             pass
 
+    @emits(signals.on_rpl_luserchannels)
     def irc_RPL_LUSERCHANNELS(self, prefix, params):
         """
         This tells us how many channels there are.
         """
         try:
-            signals.on_rpl_luserchannels.send(self, channels=int(params[1]))
+            signals.on_rpl_luserchannels.emit(self, channels=int(params[1]))
         except ValueError:
             pass
 
+    @emits(signals.on_rpl_luserme)
     def irc_RPL_LUSERME(self, prefix, params):
-        signals.on_rpl_luserme.send(self, info=params[1])
+        signals.on_rpl_luserme.emit(self, info=params[1])
 
+    @emits(signals.on_rpl_namreply, signals.on_names)
     def irc_RPL_NAMREPLY(self, prefix, params):
         """
         Receive channel users.
+
+        They're collected, until ``RPL_ENDOFNAMES``, for
+        :data:`~girclib.signals.on_names`, and only emitted line by line if
+        :data:`~girclib.signals.on_rpl_namreply` has receivers.
         """
         privacy = params[1]
         channel = params[2]
-        users = params[3].split(ascii(' '))
-        signals.on_rpl_namreply.send(
-            self, channel=channel, users=users, privacy=privacy
-        )
-
+        if signals.on_rpl_namreply.has_receivers_for(self):
+            users = params[3].split(ascii(' '))
+            signals.on_rpl_namreply.emit(
+                self, channel=channel, users=users, privacy=privacy
+            )
+        if signals.on_names.has_receivers_for(self):
+            if self._names is None:
+                self._names = {}
+            key = self.supported.fold(channel)
+            if key not in self._names:
+                self._names[key] = (channel, privacy, [])
+            self._names[key][2].extend(self.parse_names(params[3]))
+
+    @emits(signals.on_rpl_endofnames, signals.on_names)
     def irc_RPL_ENDOFNAMES(self, prefix, params):
         """
         Finished receiving channel users.
         """
         channel = params[1]
         log.debug("Finished receiving channel users for %s", channel)
-        signals.on_rpl_endofnames.send(self, channel=channel)
+        if self._names:
+            names = self._names.pop(self.supported.fold(channel), None)
+        else:
+            names = None
+        if names is not None:
+            name, privacy, members = names
+            signals.on_names.emit(self, channel=name, members=members,
+                                  privacy=privacy)
+        signals.on_rpl_endofnames.emit(self, channel=channel)
+
+    def parse_names(self, names):
+        """
+        Parse the names of a ``RPL_NAMREPLY`` message, stripping their
+        membership mode symbols, all of them with ``multi-prefix``, and
+        their ``user@host``, with ``userhost-in-names``.
+
+        :returns: ``list`` of ``(nick, modes)`` tuples, ``modes`` being the
+                  member's membership modes, ie, ``'o'``, highest first.
+        """
+        symbols = self.supported.prefix_symbols
+        members = []
+        append = members.append
+        for name in names.split(ascii(' ')):
+            if not name:
+                continue
+            modes = ''
+            if name[0] in symbols:
+                idx = 1
+                while idx < len(name) and name[idx] in symbols:
+                    idx += 1
+                modes = ''.join([symbols[symbol] for symbol in name[:idx]])
+                name = name[idx:]
+            if '!' in name:
+                name = name.split('!', 1)[0]
+            append((name, modes))
+        return members
+
+    @emits(signals.on_rpl_whoreply)
+    def irc_RPL_WHOREPLY(self, prefix, params):
+        """
+        Called for each user matching a ``WHO`` query.
+        """
+        channel, username, host, server, nick, flags = params[1:7]
+        hops, realname = (params[7].split(ascii(' '), 1) + [''])[:2]
+        signals.on_rpl_whoreply.emit(
+            self, channel=channel != '*' and channel or None,
+            user=IRCUser('%s!%s@%s' % (nick, username, host)), server=server,
+            flags=flags, hops=_int_or_default(hops), realname=realname,
+            account=None
+        )
+
+    @emits(signals.on_rpl_whoreply)
+    def irc_RPL_WHOSPCRPL(self, prefix, params):
+        """
+        Called for each user matching a ``WHO`` query sent with the WHOX
+        fields :meth:`~girclib.irc.IRCCommandsHelper.who` asks for.
+        """
+        if len(params) < 9 or params[1] != WHOX_TOKEN:
+            # Not a reply to a query of ours, we don't know it's fields
+            return
+        channel, username, host, nick, flags, account, realname = params[2:9]
+        signals.on_rpl_whoreply.emit(
+            self, channel=channel != '*' and channel or None,
+            user=IRCUser('%s!%s@%s' % (nick, username, host)), server=None,
+            flags=flags, hops=None, realname=realname,
+            account=account != '0' and account or None
+        )
 
+    @emits(signals.on_rpl_endofwho)
+    def irc_RPL_ENDOFWHO(self, prefix, params):
+        """
+        Finished receiving the replies to a ``WHO`` query.
+        """
+        signals.on_rpl_endofwho.emit(self, mask=params[1])
+
+    @emits(signals.on_rpl_list)
     def irc_RPL_LIST(self, prefix, params):
         channel = params[1]
         num_users = int(params[2])
         topic = params[3]
-        signals.on_rpl_list.send(
+        signals.on_rpl_list.emit(
             self, channel=channel, count=num_users, topic=topic
         )
 
+    @emits(signals.on_rpl_listend)
     def irc_RPL_LISTEND(self, prefix, params):
-        signals.on_rpl_listend.send(self)
+        signals.on_rpl_listend.emit(self)
+
+    def irc_CAP(self, prefix, params):
+        """
+        IRCv3 capability negotiation. The capabilities listed on
+        ``request_capabilities`` which the server supports are requested and,
+        while connecting, registration is ended once the server replies.
+        """
+        subcommand = params[1].upper()
+        names = params[-1].split()
+        if subcommand in ('LS', 'NEW'):
+            available = self._available_capabilities
+            for name in names:
+                available.add(name.split('=', 1)[0])
+            if subcommand == 'LS' and len(params) > 3 and params[2] == '*':
+                # More capabilities are coming
+                return
+            wanted = [name for name in self.request_capabilities
+                      if name in available and name not in self.capabilities]
+            if wanted:
+                self.send("CAP REQ :%s", ascii(' ').join(wanted),
+                          priority=self._registration_priority)
+            elif not self._registered:
+                self.send("CAP END", priority=PRIORITY_HIGH)
+        elif subcommand == 'ACK':
+            for name in names:
+                if name.startswith('-'):
+                    self.capabilities.discard(name[1:])
+                else:
+                    self.capabilities.add(name)
+            if not self._registered:
+                self.send("CAP END", priority=PRIORITY_HIGH)
+            signals.on_capabilities.emit(self, capabilities=self.capabilities)
+        elif subcommand == 'NAK':
+            log.warn("Server refused the capabilities: %s", params[-1])
+            if not self._registered:
+                self.send("CAP END", priority=PRIORITY_HIGH)
+        elif subcommand == 'DEL':
+            for name in names:
+                self._available_capabilities.discard(name)
+                self.capabilities.discard(name)
+            signals.on_capabilities.emit(self, capabilities=self.capabilities)
+
+    def irc_BATCH(self, prefix, params):
+        """
+        An IRCv3 batch starts, ``+reference``, or ends, ``-reference``.
+        """
+        reference = params[0]
+        if reference.startswith('+'):
+            messages = None
+            aggregate = False
+            for receiver in signals.on_batch.receivers_for(self):
+                messages = []
+                if not getattr(receiver, '_girclib_observer', False):
+                    aggregate = not self.batch_item_delivery
+                    break
+            self._batches[reference[1:]] = _Batch(
+                len(params) > 1 and params[1] or None, params[2:], messages,
+                aggregate
+            )
+        elif reference.startswith('-'):
+            batch = self._batches.pop(reference[1:], None)
+            if batch is not None and batch.messages is not None:
+                signals.on_batch.emit(
+                    self, batch_type=batch.batch_type, params=batch.params,
+                    messages=batch.messages, delivered=not batch.aggregate
+                )
 
     def irc_ERROR(self, prefix, params):
         if 'Closing Link' in params[0]:
-            self._connected.clear()
-            self._processing.clear()
-            signals.on_disconnected.send(self)
+            self._connection_lost("Server closed the link: %s." % params[0])
         else:
             log.debug("\n\nirc_ERROR(unhandled): %s\n\n", params)
 
-    def handle_command(self, prefix, command, params):
+    def handle_command(self, prefix, command, params, tags=None,
+                       message=None):
         """
         Determine the function to call for the given command and call it with
         the given arguments.
+
+        ``tags``, the message's IRCv3 message tags, are available to the
+        handler as ``message_tags``. When the parsed ``message`` is passed
+        instead, its tags are only parsed if they are read.
         """
-        if getattr(self, '_isupport_ready_event', None) is not None \
-                                                and command != 'RPL_ISUPPORT':
+        if tags is None and message is not None and message.tagged:
+            tags = message
+        self._message_tags = tags
+        if self._isupport_pending and command != 'RPL_ISUPPORT':
             # Special case so that we only issue on_rpl_isupport once we
             # have all issuport options
-            self._isupport_ready_event.set()
-            gevent.sleep(0.5)
-
-        method = getattr(self, "irc_%s" % command, None)
+            self._isupport_pending = False
+            signals.on_rpl_isupport.emit(self, options=self.supported._features)
+
+        method = self._dispatch_tables['irc'].get(command)
+        if tags and self._batches:
+            tags = self.message_tags
+            batch = self._batches.get(tags.get('batch'))
+            if batch is not None and batch.messages is not None:
+                batch.messages.append(
+                    IRCMessage(prefix, command, params, tags=tags)
+                )
+                if batch.aggregate and getattr(method, '_emits', None):
+                    # Only on_batch delivers it
+                    return
         try:
+            if method is not None:
+                method(self, prefix, params)
+                return
+            # The tables only know the class handlers, not the ones set on
+            # the instance, ie, ``client.irc_FOO = handler``
+            method = getattr(self, 'irc_%s' % command, None)
             if method is not None:
                 method(prefix, params)
             else:
                 self.irc_unknown(prefix, command, params)
         except Exception, err:
             log.exception(err)
-        gevent.sleep(0)
 
     def irc_unknown(self, prefix, command, params):
         log.warn("Un%s IRC Command. Prefix: %s; Command: %s; Params: %s;",
                  command.isdigit() and "known" or "handled", prefix,
                  command, params)
-        gevent.sleep(0)
+
+class ChannelsResult(object):
+    """
+    The outcome of joining, or leaving, several channels at once, see
+    :meth:`IRCCommandsHelper.join_many` and
+    :meth:`IRCCommandsHelper.leave_many`, filled in as the server replies.
+
+    :ivar succeeded: ``list`` of the channels joined, or left.
+    :ivar failed: ``dict`` mapping the channels which failed to the
+                  ``(error, message)`` tuple the server replied with, see
+                  :data:`~girclib.signals.on_channel_error`.
+    :ivar done: :class:`gevent.event.Event` set once every channel either
+                succeeded or failed, or the client disconnected.
+    """
+
+    def __init__(self, client, channels, leaving=False):
+        self.client = client
+        self.succeeded = []
+        self.failed = {}
+        self.done = Event()
+        fold = client.supported.fold
+        self._pending = dict([(fold(channel), channel)
+                              for channel in channels])
+        self._signals = (
+            (leaving and signals.on_left or signals.on_joined,
+             self._on_succeeded),
+            (signals.on_channel_error, self._on_channel_error),
+            (signals.on_disconnected, self._on_disconnected),
+        )
+        if not self._pending:
+            self.done.set()
+            return
+        for signal, receiver in self._signals:
+            signal.connect(receiver, sender=client, weak=False)
+
+    def __repr__(self):
+        return '<ChannelsResult succeeded=%d failed=%d pending=%d>' % (
+            len(self.succeeded), len(self.failed), len(self._pending)
+        )
+
+    @property
+    def pending(self):
+        """
+        The channels the server didn't reply about yet.
+        """
+        return self._pending.values()
+
+    def wait(self, timeout=None):
+        """
+        Wait, up to ``timeout`` seconds, for every channel to either succeed
+        or fail. Returns whether they did.
+        """
+        self.done.wait(timeout)
+        return self.done.is_set() and not self._pending
+
+    def fail(self, channel, error, message):
+        """
+        Mark ``channel`` as failed.
+        """
+        channel = self._pending.pop(self.client.supported.fold(channel), None)
+        if channel is not None:
+            self.failed[channel] = (error, message)
+            self._check_done()
+
+    def _check_done(self):
+        if not self._pending and not self.done.is_set():
+            for signal, receiver in self._signals:
+                signal.disconnect(receiver, sender=self.client)
+            self.done.set()
+
+    @inline
+    def _on_succeeded(self, emitter, channel=None):
+        channel = self._pending.pop(emitter.supported.fold(channel), None)
+        if channel is not None:
+            self.succeeded.append(channel)
+            self._check_done()
+
+    @inline
+    def _on_channel_error(self, emitter, channel=None, error=None,
+                          message=None):
+        self.fail(channel, error, message)
+
+    @inline
+    def _on_disconnected(self, emitter):
+        # Whatever is still pending stays so
+        for signal, receiver in self._signals:
+            signal.disconnect(receiver, sender=self.client)
+        self.done.set()
+
 
 class IRCCommandsHelper(IRCProtocol):
     ### user input commands, client->server
@@ -1272,6 +2211,85 @@ class IRCCommandsHelper(IRCProtocol):
         else:
             self.send("JOIN %s", channel)
 
+    def join_many(self, channels, keys=None):
+        """
+        Join several channels, with as few ``JOIN`` lines as possible.
+
+        Channels are packed into comma separated lines, those with a key
+        first, followed by their keys in the same order, as many per line as
+        ``MAX_COMMAND_LENGTH`` and the server's ``TARGMAX`` limit for
+        ``JOIN`` allow. Channels over the server's ``CHANLIMIT`` for their
+        prefix aren't sent, they fail right away with
+        ``ERR_TOOMANYCHANNELS``. The lines are queued as any other.
+
+        :type channels: ``list``
+        :param channels: The names of the channels to join. Those without a
+            prefix get ``#`` prepended to them.
+        :type keys: ``dict``
+        :param keys: The keys of the channels which need one, by name.
+        :rtype: :class:`ChannelsResult`
+        """
+        keys = keys or {}
+        names = []
+        for channel in channels:
+            key = keys.get(channel)
+            if channel[0] not in CHANNEL_PREFIXES:
+                channel = '#' + channel
+            names.append((channel, key or keys.get(channel)))
+        if not self._joining_channels_possible.is_set():
+            log.info("Waiting until joining channels is possible")
+            self._joining_channels_possible.wait()
+
+        # CHANLIMIT is a list of (prefixes, limit), the prefixes sharing it
+        limits = {}
+        for prefixes, limit in self.supported.get_feature('CHANLIMIT') or ():
+            if limit is not None:
+                shared = [limit]
+                for chantype in prefixes:
+                    limits[chantype] = shared
+        result = ChannelsResult(self, [channel for channel, key in names])
+        keyed, unkeyed = [], []
+        for channel, key in names:
+            limit = limits.get(channel[0])
+            if limit is not None:
+                if limit[0] <= 0:
+                    result.fail(channel, 'ERR_TOOMANYCHANNELS',
+                                'CHANLIMIT reached')
+                    continue
+                limit[0] -= 1
+            if key:
+                keyed.append((channel, key))
+            else:
+                unkeyed.append((channel, key))
+
+        max_targets = (self.supported.get_feature('TARGMAX') or {}).get('JOIN')
+        # The "JOIN " and the CRLF
+        room = MAX_COMMAND_LENGTH - 7
+        batch, batch_keys, size = [], [], 0
+        for channel, key in keyed + unkeyed:
+            needed = len(channel) + (key and len(key) + 1 or 0)
+            if batch and (len(batch) == max_targets or
+                          size + 1 + needed > room):
+                self._send_join(batch, batch_keys)
+                batch, batch_keys, size = [], [], 0
+            if batch:
+                size += 1
+            size += needed
+            batch.append(channel)
+            if key:
+                batch_keys.append(key)
+        if batch:
+            self._send_join(batch, batch_keys)
+        log.info("Joining %d channels on %s:%d", len(names), self.host,
+                 self.port)
+        return result
+
+    def _send_join(self, channels, keys):
+        if keys:
+            self.send("JOIN %s %s", ','.join(channels), ','.join(keys))
+        else:
+            self.send("JOIN %s", ','.join(channels))
+
     def leave(self, channel, reason=None):
         """
         Leave a channel.
@@ -1289,6 +2307,32 @@ class IRCCommandsHelper(IRCProtocol):
         else:
             self.send("PART %s", channel)
 
+    def leave_many(self, channels, reason=None):
+        """
+        Leave several channels, with as few ``PART`` lines as
+        ``MAX_COMMAND_LENGTH`` and the server's ``TARGMAX`` limit for
+        ``PART`` allow.
+
+        :type channels: ``list``
+        :param channels: The names of the channels to leave. Those without a
+            prefix get ``#`` prepended to them.
+        :type reason: ``str``
+        :param reason: If given, the reason for leaving.
+        :rtype: :class:`ChannelsResult`
+        """
+        names = [channel[0] in CHANNEL_PREFIXES and channel or '#' + channel
+                 for channel in channels]
+        result = ChannelsResult(self, names, leaving=True)
+        max_targets = (self.supported.get_feature('TARGMAX') or {}).get('PART')
+        # The "PART ", the " :reason" and the CRLF
+        room = MAX_COMMAND_LENGTH - 7 - (reason and len(reason) + 2 or 0)
+        for packed in pack_targets(names, max_targets, room):
+            if reason:
+                self.send("PART %s :%s", packed, reason)
+            else:
+                self.send("PART %s", packed)
+        return result
+
     def kick(self, channel, user, reason=None):
         """
         Attempt to kick a user from a channel.
@@ -1410,7 +2454,9 @@ class IRCCommandsHelper(IRCProtocol):
         The message will be split into multiple commands to the server if:
          - The message contains any newline characters
          - Any span between newline characters is longer than the given
-           line-length.
+           line-length, or than what fits, once encoded, on the line the
+           server relays to ``user``, prefixed by our own hostmask, see
+           :meth:`~girclib.irc.IRCProtocol.get_prefix_length`.
 
         :param user: The username or channel name to which to direct the
             message.
@@ -1429,13 +2475,16 @@ class IRCCommandsHelper(IRCProtocol):
         if length is None:
             length = MAX_COMMAND_LENGTH
 
+        # The relayed line gets our prefix, which must fit too
+        length = min(length, MAX_COMMAND_LENGTH - self.get_prefix_length())
+
         # NOTE: minimum_length really equals len(fmt) - 2 (for '%s') + 2
         # (for the line-terminating CRLF)
         minimum_length = len(fmt)
         if length <= minimum_length:
             raise ValueError("Maximum length must exceed %d for message "
                              "to %s" % (minimum_length, user))
-        for line in split(message, length - minimum_length):
+        for line in split(message, length - minimum_length, self.encoding):
             self.send(fmt, line)
 
 
@@ -1454,6 +2503,53 @@ class IRCCommandsHelper(IRCProtocol):
         self.send("NOTICE %s :%s", user, message)
 
 
+    def broadcast(self, targets, message, notice=False):
+        """
+        Send a message, or a notice, to several users and channels.
+
+        Targets are packed into as few comma separated lines as the
+        server's ``TARGMAX`` limit for the command and the maximum line
+        length allow, so announcing to hundreds of channels only takes a
+        handful of lines. Servers not announcing ``TARGMAX`` get one target
+        per line, unless they announce the older ``MAXTARGETS``.
+
+        Long messages are split as :meth:`msg` splits them, each part going
+        to every target before the next one is sent.
+
+        :type targets: ``list``
+        :param targets: The nicks and channel names to send the message to.
+        :type message: ``str``
+        :param message: The text to send.
+        :type notice: ``bool``
+        :param notice: Whether to send a ``NOTICE`` instead of a
+            ``PRIVMSG``.
+        """
+        if not targets:
+            return
+        command = notice and 'NOTICE' or 'PRIVMSG'
+        targmax = self.supported.get_feature('TARGMAX')
+        if targmax is not None:
+            max_targets = targmax.get(command, 1)
+        else:
+            max_targets = _int_or_default(
+                (self.supported.get_feature('MAXTARGETS') or ('',))[0], 1
+            )
+        # The command, the space before the targets, the space and colon
+        # after them and the CRLF
+        framing = len(command) + 5
+        longest = max([len(target) for target in targets])
+        # Each target gets the message relayed alone, with our prefix
+        length = MAX_COMMAND_LENGTH - self.get_prefix_length() - framing - \
+            longest
+        if length <= 0:
+            raise ValueError("Maximum length must exceed %d for message "
+                             "to %s" % (MAX_COMMAND_LENGTH - length, targets))
+        for line in split(message, length, self.encoding):
+            for packed in pack_targets(targets, max_targets,
+                                       MAX_COMMAND_LENGTH - framing - len(line)):
+                self.send("%s %s :%s", command, packed, line)
+
+
     def away(self, message=''):
         """
         Mark this client as away.
@@ -1486,6 +2582,32 @@ class IRCCommandsHelper(IRCProtocol):
         else:
             self.send('WHOIS %s %s', server, nickname)
 
+    def who(self, masks):
+        """
+        Query the network about the users matching ``masks``, ie, about the
+        members of some channels.
+
+        Servers whose ``TARGMAX`` allows it get several masks per query, as
+        many as fit, otherwise one query per mask is sent, all at once. The
+        replies are emitted by :data:`~girclib.signals.on_rpl_whoreply`,
+        with the user's account too if the server supports ``WHOX``, and
+        the end of each query's replies by
+        :data:`~girclib.signals.on_rpl_endofwho`.
+
+        :type masks: ``str``, ``list``
+        :param masks: The mask, or masks, to query.
+        """
+        if not isinstance(masks, (list, tuple)):
+            masks = [masks]
+        if self.supported.has_feature('WHOX'):
+            suffix = ' ' + WHOX_QUERY
+        else:
+            suffix = ''
+        targmax = self.supported.get_feature('TARGMAX') or {}
+        length = MAX_COMMAND_LENGTH - len('WHO \r\n' + suffix)
+        for packed in pack_targets(masks, targmax.get('WHO', 1), length):
+            self.send('WHO %s%s', packed, suffix)
+
     def register(self, nickname, hostname="foo", servername="bar"):
         """
         Login to the server.
@@ -1497,13 +2619,19 @@ class IRCCommandsHelper(IRCProtocol):
         :type servername: ``str``
         :param servername: If specified, the servername to logon as.
         """
+        if self.request_capabilities:
+            # Servers supporting capability negotiation hold registration
+            # until it ends, see irc_CAP
+            self.send("CAP LS 302", priority=self._registration_priority)
         if self.password not in (None, ''):
-            self.send("PASS %s", self.password)
+            self.send("PASS %s", self.password,
+                      priority=self._registration_priority)
         self.set_nick(nickname)
         if self.username is None:
             self.username = nickname
-        gevent.spawn_later(1, self.send, "USER %s %s %s :%s", self.username,
-                           hostname, servername, self.realname)
+        # The outgoing queue keeps these in order, no need to space them
+        self.send("USER %s %s %s :%s", self.username, hostname, servername,
+                  self.realname, priority=self._registration_priority)
 
     def set_nick(self, nickname):
         """
@@ -1513,7 +2641,7 @@ class IRCCommandsHelper(IRCProtocol):
         :param nickname: The nickname to change to.
         """
         self._attempted_nick = nickname
-        gevent.spawn_later(2, self.send, "NICK %s", nickname)
+        self.send("NICK %s", nickname, priority=self._registration_priority)
 
     def quit(self, message='Quiting...'):
         """
@@ -1523,8 +2651,9 @@ class IRCCommandsHelper(IRCProtocol):
         :param message: If specified, the message to give when quitting the
             server.
         """
-        gevent.spawn(self.send, "QUIT :%s" % message).join()
-        signals.on_quited.send(self)
+        self.send("QUIT :%s" % message)
+        self.flush(timeout=5)
+        signals.on_quited.emit(self)
         gevent.sleep(0)
 
     ### user input commands, client->client
@@ -1576,6 +2705,22 @@ class IRCCommandsHelper(IRCProtocol):
 
 class BaseIRCClient(IRCCommandsHelper):
 
+    _client_signals = None
+
+    @classmethod
+    def _get_client_signals(cls):
+        """
+        The ``(name, signal)`` pairs of :mod:`girclib.signals`, sorted by name.
+        """
+        if BaseIRCClient._client_signals is None:
+            BaseIRCClient._client_signals = [
+                (signame, getattr(signals, signame))
+                for signame in sorted(dir(signals))
+                if not signame.startswith('_') and
+                        isinstance(getattr(signals, signame), NamedSignal)
+            ]
+        return BaseIRCClient._client_signals
+
     @staticmethod
     def __new__(cls, *args, **kwargs):
         instance = super(BaseIRCClient, cls).__new__(cls)
@@ -1585,40 +2730,39 @@ class BaseIRCClient(IRCCommandsHelper):
         instance.supported = ServerSupportedFeatures()
 
         # Do some handled signal connections
-        for signame in sorted(dir(signals)):
-            if signame.startswith('_'):
-                continue
+        for signame, signal in cls._get_client_signals():
             func = getattr(instance, signame, None)
             if func:
-                signal = getattr(signals, signame)
-                if signal.has_receivers_for(instance):
-                    # Avoid suplicate signal connection"
-                    skip_connect = False
-                    for receiver in signal.receivers_for(instance):
-                        if receiver == func:
-                            skip_connect = True
-                            break
-#                    print (func, list(signal.receivers_for(instance)),
-#                           func in signal.receivers_for(instance))
-                    if skip_connect:
-                        log.info("Skiping signal %s. Already connected", signame)
-                        continue
+                if signal.is_connected(func, sender=instance):
+                    # Avoid duplicate signal connection
+                    log.info("Skiping signal %s. Already connected", signame)
+                    continue
                 log.info("Connecting %s to %s", func, signame)
                 signal.connect(func, sender=instance)
         return instance
 
 
+    def connect(self, network_host, network_port=6667, use_ssl=False,
+                timeout=30):
+        # What a previous server supported doesn't apply to this connection
+        self.supported = ServerSupportedFeatures()
+        return IRCCommandsHelper.connect(self, network_host, network_port,
+                                         use_ssl=use_ssl, timeout=timeout)
+
+    @inline
     def on_connected(self, emitter):
         log.debug("Connected to %s:%s", self.network_host, self.network_port)
         self.register(self.nickname, hostname=socket.gethostname(),
                       servername=socket.gethostname())
 
+    @inline
     def on_ctcp_query_ping(self, emitter, user=None, channel=None, data=None):
         """
         See :meth:`~girclib.signals.on_ctcp_query_ping`.
         """
         emitter.ctcp_make_reply(user, [("PING", data)])
 
+    @inline
     def on_ctcp_query_version(self, emitter, user=None, channel=None, data=None):
         """
         See :meth:`~girclib.signals.on_ctcp_query_version`.
@@ -1632,6 +2776,7 @@ class BaseIRCClient(IRCCommandsHelper):
                                       self.version_env or ''))
         ])
 
+    @inline
     def on_ctcp_query_source(self, emitter, user=None, channel=None, data=None):
         """
         See :meth:`~girclib.signals.on_ctcp_query_source`.
@@ -1645,6 +2790,7 @@ class BaseIRCClient(IRCCommandsHelper):
                 ('SOURCE', self.source_url), ('SOURCE', None)
             ])
 
+    @inline
     def on_ctcp_query_userinfo(self, emitter, user=None, channel=None, data=None):
         """
         See :meth:`~girclib.signals.on_ctcp_query_userinfo`.
@@ -1653,8 +2799,32 @@ class BaseIRCClient(IRCCommandsHelper):
             emitter.ctcp_make_reply(user, [('USERINFO', self.userinfo)])
 
     def on_data_available(self, data):
-        log.log(5, "Data %r", data)
-        prefix, command, args = parse_raw_irc_command(data)
-        log.debug("Prefix: %r  Command: %r  Args:%r", prefix, command, args)
-        self.pool.spawn(self.handle_command, prefix, command, args)
-        gevent.sleep(0) # Allow other greenlets to run
+        if log.isEnabledFor(5):
+            log.log(5, "Data %r", data)
+        try:
+            message = parse_irc_message(data)
+        except IRCBadMessage, err:
+            log.warning(err)
+            return
+
+        method = self._dispatch_tables['irc'].get(message.command)
+        emitted = getattr(method, '_emits', None)
+        if emitted and not self._isupport_pending and not self._batches:
+            # The handler would only emit signals, drop the message without
+            # decoding the rest of it if nothing listens to them
+            for signal in emitted:
+                if signal.has_receivers_for(self):
+                    break
+            else:
+                return
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Prefix: %r  Command: %r  Args:%r", message.prefix,
+                      message.command, message.params)
+        if self.processing_mode == PROCESSING_ORDERED:
+            # We're already on the connection's consumer greenlet
+            self.handle_command(*message.as_tuple(), message=message)
+        else:
+            self.pool.spawn(self.handle_command, *message.as_tuple(),
+                            message=message)
+            gevent.sleep(0) # Allow other greenlets to run
@@ -200,9 +200,57 @@ Called when the channel has no topic set.
 
 """)
 
+on_rpl_channelmodeis = signal("on-rpl-channelmodeis", """\
+Called with the modes currently set on a channel, usually in reply to a
+``MODE #channel`` query.
+
+:param emitter: The signal emitter.
+:type  emitter: :class:`~girclib.client.BasicIRCClient`,
+    :class:`~girclib.client.IRCClient`
+
+:type  channel: :func:`~str`
+:param channel: The channel name.
+
+:type  modes: :func:`~str`
+:param modes: The modes set on the channel.
+
+:type  args: :func:`~tuple`
+:param args: The parameter of each mode in ``modes``, ``None`` for modes
+             without one.
+
+""")
+
+on_rpl_banlist = signal("on-rpl-banlist", """\
+Called for each entry of a channel's ban, ban exceptions or invite
+exceptions list, usually in reply to a ``MODE #channel +b`` query.
+
+:param emitter: The signal emitter.
+:type  emitter: :class:`~girclib.client.BasicIRCClient`,
+    :class:`~girclib.client.IRCClient`
+
+:type  channel: :func:`~str`
+:param channel: The channel name.
+
+:type  mode: :func:`~str`
+:param mode: The list mode, ``b`` for bans, the ``EXCEPTS`` mode for ban
+             exceptions and the ``INVEX`` mode for invite exceptions.
+
+:type  mask: :func:`~str`
+:param mask: The list entry.
+
+:type  setter: :func:`~str`
+:param setter: Who set the entry, if the server says.
+
+:type  set_at: :func:`~int`
+:param set_at: When the entry was set, as a UNIX timestamp, if the server
+               says.
+
+""")
+
 on_rpl_namreply = signal("on-rpl-namreply", """\
 Called whenever we receive a channel's user list. The user's list is only
-complete when :meth:`~girclib.signals.on_rpl_endofnames` is called.
+complete when :meth:`~girclib.signals.on_rpl_endofnames` is called, see
+:data:`~girclib.signals.on_names` to get it as a whole.
 
 :param emitter: The signal emitter
 :type  emitter: :class:`~girclib.client.BasicIRCClient`,
@@ -220,6 +268,29 @@ complete when :meth:`~girclib.signals.on_rpl_endofnames` is called.
 
 """)
 
+on_names = signal("on-names", """\
+Called once we have received all of a channel's users, with all of them,
+instead of with each ``RPL_NAMREPLY`` line of the reply like
+:data:`~girclib.signals.on_rpl_namreply` is.
+
+:param emitter: The signal emitter
+:type  emitter: :class:`~girclib.client.BasicIRCClient`,
+    :class:`~girclib.client.IRCClient`
+
+:type  channel: :func:`~str`
+:param channel: The channel name.
+
+:type  members: :func:`~list`
+:param members: The channel's users, as ``(nick, modes)`` tuples, ``modes``
+    being the user's membership modes, ie, ``'o'``, highest first, see
+    :meth:`~girclib.irc.IRCProtocol.parse_names`.
+
+:type  privacy: :func:`~str`
+:param privacy: Channel privacy. One of ``@`` (secret channel), ``*`` (private
+    channel) or ``=`` (public channel).
+
+""")
+
 on_rpl_endofnames = signal("on-rpl-endofnames", """\
 Called once we have received all channel's users. See
 :meth:`~girclib.signals.on_rpl_namreply`.
@@ -233,6 +304,51 @@ Called once we have received all channel's users. See
 
 """)
 
+on_rpl_whoreply = signal("on-rpl-whoreply", """\
+Called for each user matching a ``WHO`` query, see
+:meth:`~girclib.irc.IRCCommandsHelper.who`.
+
+:param emitter: The signal emitter
+:type  emitter: :class:`~girclib.client.BasicIRCClient`,
+    :class:`~girclib.client.IRCClient`
+
+:type  channel: :func:`~str`
+:param channel: The channel the user was matched on, if any.
+
+:type  user: :class:`~girclib.irc.IRCUser`
+:param user: The user and hostmask.
+
+:type  server: :func:`~str`
+:param server: The server the user is on, ``None`` for WHOX replies.
+
+:type  flags: :func:`~str`
+:param flags: ``H`` (here) or ``G`` (gone, away), followed by ``*`` for
+    IRC operators and the user's membership mode symbols on ``channel``.
+
+:type  hops: :func:`~int`
+:param hops: How many servers away the user is, ``None`` for WHOX replies.
+
+:type  realname: :func:`~str`
+:param realname: The user's real name.
+
+:type  account: :func:`~str`
+:param account: The account the user is logged in as, ``None`` if not
+    logged in or if the server doesn't support WHOX.
+
+""")
+
+on_rpl_endofwho = signal("on-rpl-endofwho", """\
+Called once all the replies to a ``WHO`` query were received.
+
+:param emitter: The signal emitter
+:type  emitter: :class:`~girclib.client.BasicIRCClient`,
+    :class:`~girclib.client.IRCClient`
+
+:type  mask: :func:`~str`
+:param mask: The queried mask, or comma separated masks.
+
+""")
+
 on_rpl_list = signal("on_rpl_list", """\
 Called for each of the channels from a network when our client issues
 :class:`~girclib.irc.IRCCommandsHelper.list`.
@@ -550,6 +666,49 @@ A user changed their name from oldname to newname.
 
 """)
 
+on_capabilities = signal('on-capabilities', """\
+Called when the IRCv3 capabilities enabled for the connection change, ie,
+once the server acknowledged the ones requested while connecting.
+
+:param emitter: The signal emitter
+:type  emitter: :class:`~girclib.client.BasicIRCClient`,
+    :class:`~girclib.client.IRCClient`
+
+:type capabilities: :func:`~set`
+:param capabilities: The enabled capabilities.
+
+""")
+
+on_batch = signal('on-batch', """\
+Called once an IRCv3 batch, ie, a netsplit or a netjoin, ends, with all the
+messages it held.
+
+While a client has receivers connected to this signal, the messages of a
+batch which would only emit signals, like ``QUIT`` or ``JOIN``, don't emit
+them one by one, unless the client's ``batch_item_delivery`` is ``True`` or
+all those receivers are marked with :func:`~girclib.gblinker.observer`.
+
+:param emitter: The signal emitter
+:type  emitter: :class:`~girclib.client.BasicIRCClient`,
+    :class:`~girclib.client.IRCClient`
+
+:type batch_type: :func:`~str`
+:param batch_type: The batch type, ie, ``netsplit``.
+
+:type params: :func:`~list`
+:param params: The batch parameters, ie, the servers which split.
+
+:type messages: :func:`~list`
+:param messages: The :class:`~girclib.helpers.IRCMessage` objects of the
+                 batch, in the order they were received.
+
+:type delivered: :func:`~bool`
+:param delivered: Whether the messages were also handled one by one, ie,
+                  ``False`` if a ``QUIT`` in the batch didn't emit
+                  :data:`on_user_quit`.
+
+""")
+
 on_motd = signal('on-motd', """\
 I received a message-of-the-day banner from the server.
 
@@ -559,7 +718,8 @@ I received a message-of-the-day banner from the server.
 
 :type motd: :func:`~list`
 :param motd: list of strings, where each string was sent as a separate
-             message from the server.
+             message from the server, empty if the server has no message
+             of the day.
 
 To display and get a nicely formatted string, you might want to use::
 
@@ -608,6 +768,26 @@ Emitted when the login was incorrect.
 
 """)
 
+on_channel_error = signal("on-channel-error", """\
+Emitted when the server refuses to let the client join, leave or act on a
+channel, ie, because it's full or the key was wrong.
+
+:param emitter: The signal emitter
+:type  emitter: :class:`~girclib.client.BasicIRCClient`,
+    :class:`~girclib.client.IRCClient`
+
+:param channel: The channel.
+:type  channel: :func:`~str`
+
+:param error: The symbolic name of the error reply, ie,
+    ``ERR_CHANNELISFULL``, see :mod:`girclib.constants`.
+:type  error: :func:`~str`
+
+:param message: The error message.
+:type  message: :func:`~str`
+
+""")
+
 on_banned = signal("on-banned", """\
 Emitted when the client has been banned from a channel.
 
@@ -0,0 +1,601 @@
+# -*- coding: utf-8 -*-
+"""
+    girclib.state
+    ~~~~~~~~~~~~~
+
+    Optional tracking of the channels a client is on and of who is on them.
+
+    Usage::
+
+        client = IRCClient('irc.freenode.net', 6667, 'girclib')
+        state = StateTracker(client)
+        client.connect()
+        ...
+        if state.is_member('#girclib', 'someone'):
+            ...
+
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+from gevent.event import Event
+from girclib import signals
+from girclib.gblinker import inline, observer
+from girclib.exceptions import IRCBadModes
+from girclib.helpers import MaskMatcher
+from girclib.irc import IRCUser
+
+log = logging.getLogger(__name__)
+
+
+class Channel(object):
+    """
+    A channel the client is on.
+
+    Members are kept as the user ids of :class:`StateTracker`'s user table,
+    so a membership costs a ``set`` entry and, only for members with some
+    membership mode, a ``dict`` entry with the modes packed as bit flags,
+    see :meth:`StateTracker.get_member_modes`.
+
+    The channel's own modes are kept as ``CHANMODES`` classifies them, see
+    :meth:`~girclib.irc.ServerSupportedFeatures.isupport_CHANMODES`.
+
+    :ivar name: The channel name.
+    :ivar members: ``set`` of the user ids of the channel members.
+    :ivar modes: ``dict`` mapping the user ids of members with membership
+                 modes to their bit flags, ``1 << priority`` for each mode
+                 as ``PREFIX`` lists them, ``1`` being the highest.
+    :ivar settings: ``dict`` mapping the channel's parameter and flag modes
+                    to their parameter, ``None`` for flags.
+    :ivar lists: ``dict`` mapping list modes, like ``b``, to a
+                 :class:`~girclib.helpers.MaskMatcher` of their masks,
+                 created when the first mask is seen, each kept with the
+                 netmask, or nick, of who set it, if known.
+    """
+    __slots__ = ('name', 'members', 'modes', 'settings', 'lists')
+
+    def __init__(self, name):
+        self.name = name
+        self.members = set()
+        self.modes = {}
+        self.settings = {}
+        self.lists = {}
+
+    def __len__(self):
+        return len(self.members)
+
+    def __repr__(self):
+        return '<Channel %s members=%d>' % (self.name, len(self.members))
+
+
+class User(object):
+    """
+    An entry of :class:`StateTracker`'s user table.
+
+    :ivar uid: The user id.
+    :ivar nick: The nick, as last seen.
+    :ivar user: The user name, ``None`` until seen on a message prefix.
+    :ivar host: The host, ``None`` until seen on a message prefix or a
+                ``WHO`` reply.
+    :ivar account: The account the user is logged in as, ``None`` until
+                   seen on a WHOX reply, see :meth:`StateTracker.sync`.
+    :ivar channels: ``list`` of the :class:`Channel` objects the user is on,
+                    a list since users are on a few channels and a small
+                    ``set`` takes several times it's memory.
+    """
+    __slots__ = ('uid', 'nick', 'user', 'host', 'account', 'channels')
+
+    def __init__(self, uid, nick, user=None, host=None):
+        self.uid = uid
+        self.nick = nick
+        self.user = user
+        self.host = host
+        self.account = None
+        self.channels = []
+
+    def __repr__(self):
+        return '<User %d %s!%s@%s channels=%d>' % (
+            self.uid, self.nick, self.user, self.host, len(self.channels)
+        )
+
+
+def _intern(value):
+    if isinstance(value, str):
+        return intern(value)
+    return value
+
+
+class StateTracker(object):
+    """
+    Keeps track of the channels a client is on and of their members, from
+    the ``JOIN``, ``PART``, ``QUIT``, ``KICK``, ``NICK``, ``MODE`` and
+    ``NAMES`` replies the client receives, and of the channels' modes, from
+    ``MODE`` and it's ``RPL_CHANNELMODEIS`` and ban list replies.
+
+    Each user seen on a channel gets an integer id and a :class:`User`
+    entry on a table, holding it's interned nick, user and host strings
+    once, and the channels it's on. Channels only hold user ids, see
+    :class:`Channel`, so nothing is allocated per membership besides set
+    and dictionary entries. Ids are reused once their user is gone.
+
+    Channels and users are indexed by their names folded according to the
+    server's ``CASEMAPPING``, so ``Foo[`` and ``foo{`` are the same user on
+    ``rfc1459`` networks, membership and membership mode checks are O(1)
+    and renames and quits only touch the channels the user is on, never the
+    whole roster. The methods taking names fold them.
+
+    It's receivers are :func:`~girclib.gblinker.inline` so the state is
+    up to date by the time receivers running on their own greenlets see a
+    signal.
+
+    :ivar channels: ``dict`` mapping folded channel names to
+                    :class:`Channel`.
+    :ivar uids: ``dict`` mapping folded nicks to user ids.
+    :ivar table: ``list`` of :class:`User`, indexed by user id, ``None``
+                 for free ids.
+    """
+
+    _signals = ('on_joined', 'on_user_joined', 'on_left', 'on_user_left',
+                'on_kicked', 'on_user_kicked', 'on_user_quit',
+                'on_nick_changed', 'on_user_renamed', 'on_mode_changed',
+                'on_rpl_channelmodeis', 'on_rpl_banlist', 'on_names',
+                'on_rpl_whoreply', 'on_rpl_endofwho', 'on_batch',
+                'on_disconnected')
+
+    def __init__(self, client):
+        self.client = client
+        self.channels = {}
+        self.uids = {}
+        self.table = []
+        self._free_uids = []
+        self._who_pending = {}
+        for signame in self._signals:
+            getattr(signals, signame).connect(
+                getattr(self, '_%s' % signame), sender=client, weak=False
+            )
+
+    def detach(self):
+        """
+        Stop tracking the client.
+        """
+        for signame in self._signals:
+            getattr(signals, signame).disconnect(
+                getattr(self, '_%s' % signame), sender=self.client
+            )
+
+    def get_channel(self, channel):
+        """
+        The :class:`Channel` named ``channel``, ``None`` if the client is
+        not on it.
+        """
+        return self.channels.get(self.client.supported.fold(channel))
+
+    def get_user(self, nick):
+        """
+        The :class:`User` entry of ``nick``, ``None`` if it's not on any of
+        the client's channels.
+        """
+        uid = self.uids.get(self.client.supported.fold(nick))
+        if uid is not None:
+            return self.table[uid]
+
+    def get_members(self, channel):
+        """
+        The nicks of the members of ``channel``.
+
+        :rtype: ``list``
+        """
+        chan = self.get_channel(channel)
+        if chan is None:
+            return []
+        table = self.table
+        return [table[uid].nick for uid in chan.members]
+
+    def get_user_channels(self, nick):
+        """
+        The names of the channels ``nick`` is on, that the client is on too.
+
+        :rtype: ``frozenset``
+        """
+        user = self.get_user(nick)
+        if user is None:
+            return frozenset()
+        return frozenset([chan.name for chan in user.channels])
+
+    def is_member(self, channel, nick):
+        """
+        Whether ``nick`` is on ``channel``.
+        """
+        fold = self.client.supported.fold
+        uid = self.uids.get(fold(nick))
+        chan = self.channels.get(fold(channel))
+        return uid is not None and chan is not None and uid in chan.members
+
+    def get_member_modes(self, channel, nick):
+        """
+        The membership modes, ie, ``'o'``, ``nick`` has on ``channel``,
+        highest first, ``None`` if ``nick`` is not on it.
+        """
+        fold = self.client.supported.fold
+        uid = self.uids.get(fold(nick))
+        chan = self.channels.get(fold(channel))
+        if uid is None or chan is None or uid not in chan.members:
+            return None
+        flags = chan.modes.get(uid, 0)
+        if not flags:
+            return ''
+        return ''.join([
+            mode for bit, mode in self.client.supported.prefix_modes
+            if flags & bit
+        ])
+
+    def has_member_mode(self, channel, nick, mode='o'):
+        """
+        Whether ``nick`` has the membership mode ``mode`` on ``channel``, ie,
+        whether it's opped, by default.
+        """
+        supported = self.client.supported
+        bit = supported.prefix_bits.get(mode)
+        chan = self.channels.get(supported.fold(channel))
+        uid = self.uids.get(supported.fold(nick))
+        if bit is None or chan is None or uid is None:
+            return False
+        return bool(chan.modes.get(uid, 0) & bit)
+
+    def get_channel_modes(self, channel):
+        """
+        The parameter and flag modes set on ``channel``, as a ``dict``
+        mapping them to their parameter, ``None`` for flags.
+        """
+        chan = self.get_channel(channel)
+        if chan is None:
+            return {}
+        return chan.settings.copy()
+
+    def get_list(self, channel, mode='b'):
+        """
+        The masks on ``channel``'s ``mode`` list, it's ban list by default.
+
+        :rtype: ``list``
+        """
+        chan = self.get_channel(channel)
+        if chan is None or mode not in chan.lists:
+            return []
+        return list(chan.lists[mode])
+
+    def is_banned(self, channel, user):
+        """
+        Whether ``user``, an :class:`~girclib.irc.IRCUser` or a netmask,
+        matches a ban on ``channel`` and none of it's ban exceptions.
+        """
+        chan = self.get_channel(channel)
+        if chan is None or 'b' not in chan.lists:
+            return False
+        if not chan.lists['b'].matches(user):
+            return False
+        excepts = self.client.supported.get_feature('EXCEPTS') or 'e'
+        return not (excepts in chan.lists and
+                    chan.lists[excepts].matches(user))
+
+    def sync(self, channels=None):
+        """
+        Fill in the user names, hosts and, if the server supports WHOX,
+        accounts of the members of ``channels``, all the channels the client
+        is on by default, with ``WHO`` queries.
+
+        The queries are all queued at once, see
+        :meth:`~girclib.irc.IRCCommandsHelper.who`, and their replies
+        update the user table as they arrive. Channels already being synced
+        aren't queried again::
+
+            for channel, synced in state.sync().iteritems():
+                synced.wait()
+
+        :rtype: ``dict``
+        :returns: A ``dict`` mapping each channel to a
+                  :class:`gevent.event.Event` set once it's members were
+                  synced, or the client disconnected.
+        """
+        fold = self.client.supported.fold
+        if channels is None:
+            channels = [chan.name for chan in self.channels.itervalues()]
+        events = {}
+        queries = []
+        for channel in channels:
+            key = fold(channel)
+            event = self._who_pending.get(key)
+            if event is None:
+                event = self._who_pending[key] = Event()
+                queries.append(channel)
+            events[channel] = event
+        if queries:
+            self.client.who(queries)
+        return events
+
+    # ---- Index Maintenance ---------------------------------------------------
+
+    def _add_channel(self, channel):
+        key = self.client.supported.fold(channel)
+        if key not in self.channels:
+            self.channels[key] = Channel(channel)
+
+    def _add_member(self, channel, nick, flags=0, user=None, host=None):
+        fold = self.client.supported.fold
+        chan = self.channels.get(fold(channel))
+        if chan is None:
+            return
+        # Interned first so that, if it's folded already, the key is the same
+        # string
+        nick = _intern(nick)
+        key = fold(nick)
+        uid = self.uids.get(key)
+        if uid is None:
+            if self._free_uids:
+                uid = self._free_uids.pop()
+            else:
+                uid = len(self.table)
+                self.table.append(None)
+            self.uids[key] = uid
+            entry = self.table[uid] = User(uid, nick, user, host)
+        else:
+            entry = self.table[uid]
+            if entry.nick != nick:
+                entry.nick = nick
+            if user is not None:
+                entry.user, entry.host = user, host
+        if uid not in chan.members:
+            chan.members.add(uid)
+            entry.channels.append(chan)
+        if flags:
+            chan.modes[uid] = chan.modes.get(uid, 0) | flags
+
+    def _forget_user(self, key, entry):
+        del self.uids[key]
+        self.table[entry.uid] = None
+        self._free_uids.append(entry.uid)
+
+    def _remove_member(self, channel, nick):
+        fold = self.client.supported.fold
+        chan = self.channels.get(fold(channel))
+        key = fold(nick)
+        uid = self.uids.get(key)
+        if chan is None or uid is None:
+            return
+        if uid not in chan.members:
+            return
+        chan.members.discard(uid)
+        chan.modes.pop(uid, None)
+        entry = self.table[uid]
+        entry.channels.remove(chan)
+        if not entry.channels:
+            self._forget_user(key, entry)
+
+    def _remove_channel(self, channel):
+        chan = self.channels.pop(self.client.supported.fold(channel), None)
+        if chan is None:
+            return
+        fold = self.client.supported.fold
+        table = self.table
+        for uid in chan.members:
+            entry = table[uid]
+            entry.channels.remove(chan)
+            if not entry.channels:
+                self._forget_user(fold(entry.nick), entry)
+
+    def _remove_user(self, nick):
+        key = self.client.supported.fold(nick)
+        uid = self.uids.get(key)
+        if uid is None:
+            return
+        entry = self.table[uid]
+        for chan in entry.channels:
+            chan.members.discard(uid)
+            chan.modes.pop(uid, None)
+        self._forget_user(key, entry)
+
+    def _rename_user(self, nick, newnick):
+        fold = self.client.supported.fold
+        key, newkey = fold(nick), fold(newnick)
+        uid = self.uids.get(key)
+        if uid is None:
+            return
+        if key != newkey:
+            del self.uids[key]
+            self.uids[newkey] = uid
+        # The id, and so the memberships, stay the same
+        self.table[uid].nick = _intern(newnick)
+
+    def _add_list_entry(self, channel, mode, mask, setter=None):
+        fold = self.client.supported.fold
+        chan = self.channels.get(fold(channel))
+        if chan is None:
+            return
+        if mode not in chan.lists:
+            chan.lists[mode] = MaskMatcher(fold=fold)
+        chan.lists[mode].add(mask, setter)
+
+    def _set_modes(self, channel, set, modes, args, setter=None):
+        supported = self.client.supported
+        fold = supported.fold
+        chan = self.channels.get(fold(channel))
+        if chan is None:
+            # Not a channel we're on, or a user mode change
+            return
+        kinds = supported.channel_mode_kinds
+        mode_bits = supported.prefix_bits
+        for mode, arg in zip(modes, args):
+            kind = kinds.get(mode)
+            if kind == 'prefix':
+                if arg is None:
+                    continue
+                bit = mode_bits[mode]
+                uid = self.uids.get(fold(arg))
+                if uid is None or uid not in chan.members:
+                    continue
+                flags = chan.modes.get(uid, 0)
+                if set:
+                    chan.modes[uid] = flags | bit
+                elif flags & ~bit:
+                    chan.modes[uid] = flags & ~bit
+                else:
+                    chan.modes.pop(uid, None)
+            elif kind == 'addressModes':
+                if arg is None:
+                    continue
+                if set:
+                    self._add_list_entry(channel, mode, arg,
+                                         setter and setter.netmask)
+                elif mode in chan.lists:
+                    chan.lists[mode].remove(arg)
+            elif set:
+                chan.settings[mode] = arg
+            else:
+                chan.settings.pop(mode, None)
+
+    # ---- Signal Receivers ----------------------------------------------------
+    @inline
+    def _on_joined(self, emitter, channel=None):
+        self._add_channel(channel)
+        self._add_member(channel, emitter.nickname)
+
+    @inline
+    def _on_user_joined(self, emitter, channel=None, user=None):
+        self._add_member(channel, user.nick, user=user.user, host=user.host)
+
+    @inline
+    def _on_left(self, emitter, channel=None):
+        self._remove_channel(channel)
+
+    @inline
+    def _on_user_left(self, emitter, channel=None, user=None):
+        self._remove_member(channel, user.nick)
+
+    @inline
+    def _on_kicked(self, emitter, channel=None, kicker=None, message=None):
+        self._remove_channel(channel)
+
+    @inline
+    def _on_user_kicked(self, emitter, channel=None, kicked=None, kicker=None,
+                        message=None):
+        self._remove_member(channel, kicked)
+
+    @inline
+    def _on_user_quit(self, emitter, user=None, message=None):
+        self._remove_user(user.nick)
+
+    @inline
+    def _on_nick_changed(self, emitter, user=None, newnick=None):
+        self._rename_user(user.nick, newnick)
+
+    @inline
+    def _on_user_renamed(self, emitter, user=None, newnick=None):
+        self._rename_user(user.nick, newnick)
+
+    @inline
+    def _on_mode_changed(self, emitter, user=None, channel=None, set=None,
+                         modes=None, args=None):
+        self._set_modes(channel, set, modes, args, user)
+
+    @inline
+    def _on_rpl_channelmodeis(self, emitter, channel=None, modes=None,
+                              args=None):
+        chan = self.get_channel(channel)
+        if chan is not None:
+            chan.settings.clear()
+            self._set_modes(channel, True, modes, args)
+
+    @inline
+    def _on_rpl_banlist(self, emitter, channel=None, mode=None, mask=None,
+                        setter=None, set_at=None):
+        # The reply names the list, whatever CHANMODES says about the mode
+        self._add_list_entry(channel, mode, mask, setter)
+
+    @inline
+    def _on_names(self, emitter, channel=None, members=None, privacy=None):
+        if emitter.supported.fold(channel) not in self.channels:
+            # A NAMES reply for a channel we're not on
+            return
+        mode_bits = emitter.supported.prefix_bits
+        for nick, modes in members:
+            flags = 0
+            for mode in modes:
+                flags |= mode_bits[mode]
+            if nick:
+                self._add_member(channel, nick, flags)
+
+    @inline
+    def _on_rpl_whoreply(self, emitter, channel=None, user=None, server=None,
+                         flags=None, hops=None, realname=None, account=None):
+        uid = self.uids.get(emitter.supported.fold(user.nick))
+        if uid is None:
+            # Not on any of our channels
+            return
+        entry = self.table[uid]
+        entry.user, entry.host = user.user, user.host
+        if account is not None:
+            entry.account = _intern(account)
+
+    @inline
+    def _on_rpl_endofwho(self, emitter, mask=None):
+        if not self._who_pending:
+            return
+        fold = emitter.supported.fold
+        for channel in mask.split(','):
+            event = self._who_pending.pop(fold(channel), None)
+            if event is not None:
+                event.set()
+
+    @inline
+    @observer
+    def _on_batch(self, emitter, batch_type=None, params=None, messages=None,
+                  delivered=True):
+        if delivered:
+            # We've seen each message's signals already
+            return
+        for message in messages:
+            command, params = message.command, message.params
+            if command == 'QUIT':
+                self._remove_user(IRCUser(message.prefix).nick)
+            elif command == 'JOIN':
+                user = IRCUser(message.prefix)
+                if emitter.is_nickname(user.nick):
+                    self._on_joined(emitter, channel=params[-1])
+                else:
+                    self._add_member(params[-1], user.nick, user=user.user,
+                                     host=user.host)
+            elif command == 'PART':
+                nick = IRCUser(message.prefix).nick
+                if emitter.is_nickname(nick):
+                    self._remove_channel(params[0])
+                else:
+                    self._remove_member(params[0], nick)
+            elif command == 'KICK':
+                if emitter.is_nickname(params[1]):
+                    self._remove_channel(params[0])
+                else:
+                    self._remove_member(params[0], params[1])
+            elif command == 'MODE':
+                try:
+                    channel, added, removed = emitter.parse_mode_change(params)
+                except IRCBadModes:
+                    continue
+                for set, changes in ((True, added), (False, removed)):
+                    if changes:
+                        modes, args = zip(*changes)
+                        self._set_modes(channel, set, modes, args,
+                                        IRCUser(message.prefix))
+            elif command == 'RPL_NAMREPLY':
+                self._on_names(emitter, channel=params[2],
+                               members=emitter.parse_names(params[3]))
+
+    @inline
+    def _on_disconnected(self, emitter):
+        self.channels.clear()
+        self.uids.clear()
+        del self.table[:]
+        del self._free_uids[:]
+        for event in self._who_pending.itervalues():
+            event.set()
+        self._who_pending.clear()